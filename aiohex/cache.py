@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local cache of aggregated transitions which is updated with the hits
+inserted since it was last saved.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+from . import markov
+
+class TransitionCache:
+  """
+  Aggregated transition counts of all hits with `id <= watermark`.
+
+  To handle sessions continuing after the watermark, the last page of
+  each session is remembered, so its exit transition can be replaced by
+  the transition to the next page once it arrives. Until the session is
+  idle for long enough to be forgotten by `prune`.
+
+  >>> tc = TransitionCache()
+  >>> tc.update([1, 2], [7, 7], [1, 2], [0, 10])
+  >>> tc.counts.edges()
+  [(1, 2, 1), (2, 0, 1)]
+  >>> tc.update([3, 1], [7, 8], [3, 4], [20, 100])
+  >>> tc.counts.edges()
+  [(1, 0, 1), (1, 2, 1), (2, 3, 1), (3, 0, 1)]
+  >>> tc.watermark
+  4
+  >>> tc.prune(60), sorted(tc.tails)
+  (1, [8])
+  """
+
+  # bump when the pickled attributes change
+  version = 2
+
+  def __init__(tc):
+    tc.counts = markov.Counts()
+    tc.watermark = 0
+    # session: (last page, time of the last hit)
+    tc.tails = dict()
+    # time of the latest hit
+    tc.latest = float('-inf')
+
+  @classmethod
+  def load(cls, path):
+    """
+    :returns: the cache saved at `path`, or an empty one if there is
+      none or it was saved by an incompatible version
+    :rtype: TransitionCache
+    """
+    try:
+      with open(path, 'rb') as f:
+        tc = pickle.load(f)
+    except FileNotFoundError:
+      return cls()
+
+    if getattr(tc, '_version', None) != cls.version:
+      return cls()
+
+    return tc
+
+  def save(tc, path):
+    """
+    Atomically replaces the cache at `path`.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+      tc._version = tc.version
+      pickle.dump(tc, f, pickle.HIGHEST_PROTOCOL)
+      f.flush()
+      os.fsync(f.fileno())
+
+    os.replace(tmp, path)
+
+  def update(tc, pages, sessions, ids, times, keys = None):
+    """
+    Merges hits with `id > watermark` into the cache.
+
+    :param pages: visited pages sorted by session and then by id.
+      Each session must be complete, ie. no hits of the sessions may
+      follow in a later update except ones inserted after this one.
+    :type  pages: [int]
+
+    :param sessions: session of each hit
+    :type  sessions: [object]
+
+    :param ids: id of each hit
+    :type  ids: [int]
+
+    :param times: time of each hit in seconds since the epoch
+    :type  times: [float]
+
+    :param keys: session id of each hit to remember the sessions by,
+      `sessions` if None. Lets `sessions` be cheaply compared codes.
+    :type  keys: [object]
+    """
+    if not len(pages):
+      return
+
+    pages = np.asarray(pages, dtype = np.int64)
+    sessions = np.asarray(sessions)
+    times = np.asarray(times, dtype = float)
+
+    keys = sessions.tolist() if keys is None else keys
+
+    last = markov.session_ends(sessions)
+    first = np.flatnonzero(np.roll(last, 1)).tolist()
+    last = np.flatnonzero(last).tolist()
+
+    # sessions which already had hits: their exit becomes a transition
+    # to the first new page
+    us, vs, ns = [], [], []
+    for sid, page in zip([keys[i] for i in first], pages[first].tolist()):
+      tail, _ = tc.tails.get(sid, (None, None))
+      if tail is not None:
+        us += [tail, tail]
+        vs += [markov.Counts.exit_state, page]
+        ns += [-1, 1]
+
+    tc.counts += markov.Counts.from_sessions(pages, sessions)
+    tc.counts += markov.Counts(us, vs, ns)
+
+    tc.tails.update(zip(
+      [keys[i] for i in last]
+    , zip(pages[last].tolist(), times[last].tolist())
+    ))
+    tc.watermark = max(tc.watermark, int(np.max(ids)))
+    tc.latest = max(tc.latest, float(np.max(times)))
+
+  def prune(tc, idle):
+    """
+    Forgets the last pages of sessions without a hit in the `idle`
+    seconds before the latest hit, so the next hit of such a session
+    starts a new one, as it does after `model.close_sessions`.
+
+    :param idle:
+    :type  idle: float
+
+    :returns: number of forgotten sessions
+    :rtype: int
+    """
+    horizon = tc.latest - idle
+    idle_sessions = [
+      sid for sid, (_, time) in tc.tails.items() if time < horizon
+    ]
+    for x in idle_sessions:
+      del tc.tails[x]
+
+    return len(idle_sessions)
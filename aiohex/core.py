@@ -3,18 +3,30 @@
 import argparse
 import asyncio
 import configparser
+import functools
 import itertools
+import json
+import os
+import signal
 import sys
+import time
+import traceback
 import uuid
 
 from aiohttp import web
 from xdg import BaseDirectory
 
+from . import cache
 from . import model
 from . import session
 from . import markov
+from . import pages
+from . import spool
 from . import test_model
 
+page_numbers = range(1, 4)
+"""pages linked from every page"""
+
 def create_body(pn):
   """
   :param pn: page number
@@ -25,7 +37,7 @@ def create_body(pn):
   """
   return '<html><head></head><body><h1>{}</h1><p>{}</p></body></html>'.format(
     pn
-  , "".join(['<a href="/{0}">{0}</a>'.format(x) for x in range(1,4)])
+  , "".join(['<a href="/{0}">{0}</a>'.format(x) for x in page_numbers])
   ).encode("utf-8")
 
 async def page_view(r):
@@ -37,16 +49,52 @@ async def page_view(r):
   except ValueError:
     raise web.HTTPNotFound
 
+  # 0 is the exit state of the transitions
+  if pn < 1:
+    raise web.HTTPNotFound
+
   peer = r.transport.get_extra_info('peername')
-  await model.register_hit(
-    r.app['db']
-  , pn
-  , r['session'].id
-  , peer[0]
-  , peer[1]
-  , dict(r.headers)
+  try:
+    await r.app['register_hit'](
+      pn
+    , r['session'].id
+    , peer[0]
+    , peer[1]
+    , r.app['capture_headers'](r.headers.items())
+    )
+  except model.Overloaded:
+    raise web.HTTPServiceUnavailable(headers = {'Retry-After': '1'})
+
+  pc = r.app['pages']
+  body, etag, coding = pc.select(pn, r.headers.get('Accept-Encoding', ''))
+  headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+
+  if_none_match = r.headers.get('If-None-Match')
+  if if_none_match is not None and pc.not_modified(etag, if_none_match):
+    # the hit is recorded anyway
+    return web.Response(status = 304, headers = headers)
+
+  if coding != 'identity':
+    headers['Content-Encoding'] = coding
+
+  return web.Response(body = body, headers = headers)
+
+async def stats_view(r):
+  """
+  :returns: statistics of the process serving the request
+  """
+  stats = dict(pool = r.app['db'].stats())
+  if 'admission' in r.app:
+    stats['admission'] = r.app['admission'].stats()
+  if 'hit_buffer' in r.app:
+    stats['hit_buffer'] = dict(depth = r.app['hit_buffer'].depth)
+  sessions = session.store_stats(r.app)
+  if sessions is not None:
+    stats['sessions'] = sessions
+  return web.Response(
+    text         = json.dumps(stats, sort_keys = True)
+  , content_type = 'application/json'
   )
-  return web.Response(body = create_body(pn))
 
 async def root_view(r):
   """
@@ -74,13 +122,149 @@ class Config:
   :param session_cookie_name:
   :type  session_cookie_name: str
 
+  :param session_ttl: Seconds after which an unused session is
+    forgotten by the server. 0 to never forget.
+  :type  session_ttl: float
+
+  :param session_max_entries: Maximum number of sessions remembered by
+    the server. The least recently used ones are forgotten first.
+    0 for no limit.
+  :type  session_max_entries: int
+
+  :param session_secret: Secret key to sign session cookies with.
+    Cookies are not signed if not set.
+  :type  session_secret: str
+
+  :param session_store: Where the server remembers sessions. `memory`,
+    `sqlite` database at `session_db` shared by all local processes, or
+    `none` to rely on the signatures only, which requires
+    `session_secret`. Then `session_ttl` limits the age of signatures
+    instead.
+  :type  session_store: str
+
+  :param session_db: Path of the sqlite session store.
+  :type  session_db: str
+
+  :param session_flush_interval: Seconds after which the sqlite session
+    store writes the updated times of last use of the sessions.
+  :type  session_flush_interval: float
+
   :param ip: ip to bind to
   :type  ip: str
 
   :param port: port to bind to
   :type  port: int
 
+  :param workers: number of processes serving the port
+  :type  workers: int
+
+  :param page_encodings: Content codings in which the pages are
+    precomputed, in order of preference. One or more of
+    `pages.encodings`. Pages are not compressed if empty.
+  :type  page_encodings: [str]
+
+  :param header_allow: Names of the request headers stored with each
+    hit. All headers are stored if not set, none if empty.
+  :type  header_allow: [str]
+
+  :param header_max_length: Maximum length of stored header values.
+    0 for no limit.
+  :type  header_max_length: int
+
+  :param header_cache_size: Number of header sets each process
+    remembers as stored, so it does not insert them again. 0 for no
+    limit.
+  :type  header_cache_size: int
+
+  :param pool_minsize: Number of database connections opened upfront
+    by each process.
+  :type  pool_minsize: int
+
+  :param pool_maxsize: Maximum number of database connections of each
+    process.
+  :type  pool_maxsize: int
+
+  :param pool_acquire_timeout: Seconds after which waiting for a
+    database connection fails. 0 to wait indefinitely.
+  :type  pool_acquire_timeout: float
+
+  :param statement_timeout: Seconds after which the database aborts a
+    statement. 0 for the server's default.
+  :type  statement_timeout: float
+
+  :param prepare_statements: Insert hits using a prepared statement.
+    Disable when connecting through a pooler in transaction mode.
+  :type  prepare_statements: bool
+
+  :param stats_path: URL path serving statistics of the process as
+    JSON. Not served if not set.
+  :type  stats_path: str
+
+  :param max_hits_in_flight: Maximum number of hits being recorded at
+    once by each process. 0 for no limit.
+  :type  max_hits_in_flight: int
+
+  :param overload_policy: What to do with hits over
+    `max_hits_in_flight`. One of `model.HitAdmission.policies`.
+  :type  overload_policy: str
+
+  :param overload_sample_rate: Fraction of the hits over
+    `max_hits_in_flight` recorded with the `sample` policy.
+  :type  overload_sample_rate: float
+
   :param model: Database model to use. Relevant only to self-tests.
+
+  :param buffer: Record hits through `model.HitBuffer` instead of
+    inserting each one while the request waits.
+  :type  buffer: bool
+
+  :param buffer_flush_size: Maximum number of hits per INSERT.
+  :type  buffer_flush_size: int
+
+  :param buffer_flush_interval: Maximum number of seconds a buffered hit
+    waits for its batch to fill up.
+  :type  buffer_flush_interval: float
+
+  :param buffer_max_queue: Maximum number of buffered hits. Requests
+    wait for the buffer to be flushed once it is full.
+  :type  buffer_max_queue: int
+
+  :param spool_dir: Directory to spool hits to when the database can not
+    keep up. Requires `buffer`. Spooling is disabled if not set.
+  :type  spool_dir: str
+
+  :param spool_segment_size: Size in bytes of spool segments.
+  :type  spool_segment_size: int
+
+  :param spool_fsync: One of `spool.Spool.fsync_policies`.
+  :type  spool_fsync: str
+
+  :param spool_replay_interval: Seconds between spool replay attempts.
+  :type  spool_replay_interval: float
+
+  :param fetch_size: Number of hits fetched at once when streaming them
+    from the database.
+  :type  fetch_size: int
+
+  :param track_transitions: Count transitions in the database as the
+    hits are inserted.
+  :type  track_transitions: bool
+
+  :param session_idle: Seconds after which a session without hits is
+    closed by the `close-sessions` command.
+  :type  session_idle: float
+
+  :param transitions_cache: Path of `cache.TransitionCache` for the
+    aggregated transitions. Disabled if not set.
+  :type  transitions_cache: str
+
+  :param partition_by: Column to range partition the hits table by.
+    One of `model.partition_columns`. Not partitioned if not set.
+  :type  partition_by: str
+
+  :param partition_size: Number of ids per partition when partitioned
+    by id.
+  :type  partition_size: int
   """
 
   _models = dict(
@@ -89,6 +273,8 @@ class Config:
   , fixture = test_model.Fixture()
   )
 
+  _session_stores = ('memory', 'sqlite', 'none')
+
   def __init__(c, path):
     try:
       c.load(path)
@@ -110,13 +296,126 @@ class Config:
     , 'AIOHEX_ID'
     )
 
+    c.session_ttl = cp.getfloat('core', 'session_ttl', fallback = 1800)
+    c.session_max_entries = cp.getint(
+      'core', 'session_max_entries', fallback = 1000000
+    )
+
+    c.session_secret = core.get('session_secret') or None
+    c.session_store = core.setdefault('session_store', 'memory')
+    if c.session_store not in c._session_stores:
+      raise ConfigurationError(
+        'Invalid session_store ' + repr(c.session_store)
+      )
+
+    if c.session_store == 'none' and not c.session_secret:
+      raise ConfigurationError('session_store = none requires session_secret')
+
+    c.session_db = core.get('session_db') or None
+    if c.session_store == 'sqlite' and not c.session_db:
+      raise ConfigurationError('session_store = sqlite requires session_db')
+
+    c.session_flush_interval = cp.getfloat(
+      'core', 'session_flush_interval', fallback = 1.0
+    )
+
     c.ip   = core.setdefault('ip', '127.0.0.1')
     c.port = cp.getint('core', 'port', fallback = 8080)
+    c.workers = cp.getint('core', 'workers', fallback = 1)
+
+    c.page_encodings = core.setdefault(
+      'page_encodings'
+    , ' '.join(pages.encodings)
+    ).replace(',', ' ').split()
+    for x in c.page_encodings:
+      if x not in pages.encodings:
+        raise ConfigurationError('Invalid page_encodings ' + repr(x))
+
+    c.header_allow = core.get('header_allow')
+    if c.header_allow is not None:
+      c.header_allow = c.header_allow.replace(',', ' ').split()
+
+    c.header_max_length = cp.getint(
+      'core', 'header_max_length', fallback = 0
+    )
+
+    c.header_cache_size = cp.getint(
+      'core', 'header_cache_size', fallback = 10000
+    )
+
+    c.pool_minsize = cp.getint('core', 'pool_minsize', fallback = 1)
+    c.pool_maxsize = cp.getint('core', 'pool_maxsize', fallback = 10)
+    c.pool_acquire_timeout = cp.getfloat(
+      'core', 'pool_acquire_timeout', fallback = 0
+    )
+    c.statement_timeout = cp.getfloat(
+      'core', 'statement_timeout', fallback = 0
+    )
+    c.prepare_statements = cp.getboolean(
+      'core', 'prepare_statements', fallback = True
+    )
+    c.stats_path = core.get('stats_path') or None
+
+    c.max_hits_in_flight = cp.getint(
+      'core', 'max_hits_in_flight', fallback = 0
+    )
+    c.overload_policy = core.setdefault('overload_policy', 'wait')
+    if c.overload_policy not in model.HitAdmission.policies:
+      raise ConfigurationError(
+        'Invalid overload_policy ' + repr(c.overload_policy)
+      )
+
+    c.overload_sample_rate = cp.getfloat(
+      'core', 'overload_sample_rate', fallback = 0.1
+    )
 
     c._model = core.setdefault('model', 'actual')
     if c._model not in c._models.keys():
       raise ConfigurationError('Invalid model ' + repr(c._model))
 
+    c.buffer = cp.getboolean('core', 'buffer', fallback = False)
+    c.buffer_flush_size = cp.getint(
+      'core', 'buffer_flush_size', fallback = 500
+    )
+    c.buffer_flush_interval = cp.getfloat(
+      'core', 'buffer_flush_interval', fallback = 1.0
+    )
+    c.buffer_max_queue = cp.getint(
+      'core', 'buffer_max_queue', fallback = 10000
+    )
+
+    c.spool_dir = core.get('spool_dir') or None
+    if c.spool_dir and not c.buffer:
+      raise ConfigurationError('spool_dir requires buffer = on')
+
+    c.spool_segment_size = cp.getint(
+      'core', 'spool_segment_size', fallback = 16 * 1024 * 1024
+    )
+    c.spool_fsync = core.setdefault('spool_fsync', 'rotate')
+    if c.spool_fsync not in spool.Spool.fsync_policies:
+      raise ConfigurationError('Invalid spool_fsync ' + repr(c.spool_fsync))
+
+    c.spool_replay_interval = cp.getfloat(
+      'core', 'spool_replay_interval', fallback = 5.0
+    )
+
+    c.fetch_size = cp.getint('core', 'fetch_size', fallback = 10000)
+
+    c.track_transitions = cp.getboolean(
+      'core', 'track_transitions', fallback = False
+    )
+    c.session_idle = cp.getfloat('core', 'session_idle', fallback = 1800)
+
+    c.transitions_cache = core.get('transitions_cache') or None
+
+    c.partition_by = core.get('partition_by') or None
+    if c.partition_by not in (None,) + model.partition_columns:
+      raise ConfigurationError('Invalid partition_by ' + repr(c.partition_by))
+
+    c.partition_size = cp.getint(
+      'core', 'partition_size', fallback = 10000000
+    )
+
   def create_cookie_config(c):
     """
     :returns: session.CookieConfig
@@ -125,6 +424,131 @@ class Config:
       name     = c.session_cookie_name
     , secure   = c.ssl
     , httponly = True
+    , signer   = c.create_signer()
+    )
+
+  def create_signer(c):
+    """
+    :returns: session.Signer or None if cookies are not signed
+    """
+    if not c.session_secret:
+      return None
+
+    return session.Signer(
+      c.session_secret.encode('utf-8')
+    , max_age = c.session_ttl or None
+    )
+
+  def create_session_store_factory(c):
+    """
+    :returns: factory of the session store
+    """
+    if c.session_store == 'none':
+      return session.NullStore
+
+    if c.session_store == 'sqlite':
+      return functools.partial(
+        session.SqliteStore
+      , c.session_db
+      , ttl            = c.session_ttl or None
+      , flush_interval = c.session_flush_interval
+      )
+
+    return functools.partial(
+      session.MemoryStore
+    , ttl         = c.session_ttl or None
+    , max_entries = c.session_max_entries or None
+    )
+
+  def create_page_cache(c):
+    """
+    :returns: pages.PageCache
+    """
+    return pages.PageCache(
+      create_body
+    , page_numbers
+    , encodings = c.page_encodings
+    )
+
+  def create_header_policy(c):
+    """
+    :returns: model.HeaderPolicy
+    """
+    return model.HeaderPolicy(
+      allow      = c.header_allow
+    , max_length = c.header_max_length or None
+    )
+
+  def create_hit_buffer(c, engine):
+    """
+    :returns: model.HitBuffer
+    """
+    return c.model.HitBuffer(
+      engine
+    , flush_size      = c.buffer_flush_size
+    , flush_interval  = c.buffer_flush_interval
+    , max_queue       = c.buffer_max_queue
+    , spool           = c.create_spool()
+    , replay_interval = c.spool_replay_interval
+    , header_cache    = c.create_header_cache()
+    )
+
+  def create_hit_admission(c, register_hit):
+    """
+    :returns: model.HitAdmission
+    """
+    return model.HitAdmission(
+      register_hit
+    , max_in_flight = c.max_hits_in_flight
+    , policy        = c.overload_policy
+    , sample_rate   = c.overload_sample_rate
+    )
+
+  def create_header_cache(c):
+    """
+    :returns: model.HeaderSetCache
+    """
+    return model.HeaderSetCache(max_entries = c.header_cache_size or None)
+
+  def create_spool(c):
+    """
+    :returns: spool.Spool or None if spooling is disabled
+    """
+    if not c.spool_dir:
+      return None
+
+    return spool.Spool(
+      c.spool_dir
+    , segment_size = c.spool_segment_size
+    , fsync        = c.spool_fsync
+    )
+
+  def connect(c, setup_schema = True):
+    """
+    :param setup_schema: see `model.connect`
+
+    :returns: engine of the configured model
+    """
+    return c.model.connect(
+      c.dsn
+    , track_transitions = c.track_transitions
+    , partition_by      = c.partition_by
+    , pool_minsize      = c.pool_minsize
+    , pool_maxsize      = c.pool_maxsize
+    , acquire_timeout   = c.pool_acquire_timeout or None
+    , statement_timeout = c.statement_timeout or None
+    , prepare           = c.prepare_statements
+    , setup_schema      = setup_schema
+    )
+
+  def create_tables(c):
+    """
+    Creates and migrates the schema of the configured model.
+    """
+    c.model.create_tables(
+      c.dsn
+    , track_transitions = c.track_transitions
+    , partition_by      = c.partition_by
     )
 
   @property
@@ -144,15 +568,67 @@ def main():
   )
 
   sub = p.add_subparsers(dest = 'command')
-  sub.add_parser("serve", help = serve.__doc__)
+  sp = sub.add_parser("serve", help = serve.__doc__)
+  sp.add_argument("--workers", type = int
+  , help = "Number of worker processes. Defaults to the workers option."
+  )
 
   tp = sub.add_parser("transitions", help = transitions.__doc__)
   tp.add_argument("--session-id", type = uuid.UUID
   , help = "Show transitions for given session-id only"
   )
+  tp.add_argument("--streaming", action = 'store_true'
+  , help = "Aggregate the session graphs one by one instead of letting"
+      " the database count the transitions"
+  )
+  tp.add_argument("--top-k", type = int
+  , help = "Show only given number of the most probable transitions from"
+      " each page, or of the top pages"
+  )
+  mode = tp.add_mutually_exclusive_group()
+  mode.add_argument("--stationary", action = 'store_true'
+  , help = "Show the long-run share of page views of each page"
+  )
+  mode.add_argument("--reach", type = int, metavar = "STEPS"
+  , help = "Show the probability of viewing each page after given number"
+      " of transitions from the start of a session"
+  )
+  mode.add_argument("--session-length", action = 'store_true'
+  , help = "Show the expected number of page views of a session from each"
+      " page on"
+  )
+
+  pp = sub.add_parser("paths", help = paths.__doc__)
+  pp.add_argument("--order", type = int, default = 3
+  , help = "Maximum number of pages of a path, including the exit"
+  )
+  pp.add_argument("--top", type = int, default = 10
+  , help = "Number of the most common paths to show"
+  )
+  pp.add_argument("--max-paths", type = int, default = 1000000
+  , help = "Number of paths kept while counting. The rarest paths are"
+      " forgotten beyond it, making their counts lower bounds."
+  )
 
   sub.add_parser("sessions", help = sessions.__doc__)
 
+  cp = sub.add_parser("close-sessions", help = close_sessions.__doc__)
+  cp.add_argument("--idle", type = float
+  , help = "Close sessions idle for this many seconds."
+      " Defaults to the session_idle option."
+  )
+
+  sub.add_parser("repair-transitions", help = repair_transitions.__doc__)
+
+  pp = sub.add_parser("partitions", help = partitions.__doc__)
+  pp.add_argument("--ahead", type = int, default = 1
+  , help = "Number of partitions to create after the current one"
+  )
+  pp.add_argument("--drop-before", type = int
+  , help = "Drop partitions holding only lower ids, or lower months when"
+      " partitioned by created, given as YYYYMM"
+  )
+
   args = p.parse_args(sys.argv[1:])
 
   try:
@@ -161,11 +637,15 @@ def main():
     print(e)
     sys.exit(2)
 
-  dispatch = dict(
-    serve       = serve
-  , transitions = transitions
-  , sessions    = sessions
-  )
+  dispatch = {
+    'serve'              : serve
+  , 'transitions'        : transitions
+  , 'paths'              : paths
+  , 'sessions'           : sessions
+  , 'close-sessions'     : close_sessions
+  , 'repair-transitions' : repair_transitions
+  , 'partitions'         : partitions
+  }
 
   sys.exit(dispatch[args.command](
     args
@@ -178,63 +658,345 @@ def serve(args, _, c, model):
   """
   Start HTTP server
   """
+  workers = c.workers if args.workers is None else args.workers
+  if workers < 1:
+    print("At least one worker is required")
+    return 2
+
+  if workers == 1:
+    web.run_app(create_app(c, model), host = c.ip, port = c.port)
+    return 0
+
+  if c.session_store == 'memory':
+    # each worker would know only its own sessions
+    print("Multiple workers require session_store = sqlite or none")
+    return 2
+
+  # once, as the DDL locks the tables the other workers are using
+  c.create_tables()
+
+  return supervise(workers, functools.partial(run_worker, c, model))
+
+def create_app(c, model, setup_schema = True):
+  """
+  :param setup_schema: see `model.connect`
+
+  :returns: the web application connected to the database
+  :rtype: aiohttp.web.Application
+  """
   # setup session management
   app = web.Application(middlewares = [
-    session.create_middleware_factory(c.create_cookie_config())
+    session.create_middleware_factory(
+      c.create_cookie_config()
+    , store_factory = c.create_session_store_factory()
+    )
   ])
+  app.on_cleanup.append(session.close_store)
 
   # setup url routing
   app.router.add_route('GET', '/'    , root_view)
+  if c.stats_path:
+    app.router.add_route('GET', c.stats_path, stats_view)
   app.router.add_route('GET', '/{pn}', page_view)
-  app['db'] = model.connect(c.dsn)
+  app['pages'] = c.create_page_cache()
+  app['capture_headers'] = c.create_header_policy()
+  app['db'] = c.connect(setup_schema)
   c.forget_dsn()
 
-  # run
-  web.run_app(app, host = c.ip, port = c.port)
+  # setup hit recording
+  if c.buffer:
+    hb = c.create_hit_buffer(app['db'])
+    app.on_startup.append(lambda app: hb.start())
+    app.on_cleanup.append(lambda app: hb.close())
+    app['register_hit'] = hb.register_hit
+    app['hit_buffer'] = hb
+  else:
+    app['register_hit'] = functools.partial(
+      model.register_hit
+    , app['db']
+    , header_cache = c.create_header_cache()
+    )
+
+  if c.max_hits_in_flight:
+    app['admission'] = c.create_hit_admission(app['register_hit'])
+    app['register_hit'] = app['admission'].register_hit
+
+  return app
+
+def supervise(n, worker):
+  """
+  Runs `worker(i)` in `n` forked processes, restarting those which exit
+  until SIGTERM or SIGINT is received. The signal is then passed on to
+  the workers.
+
+  :param worker: returns exit code of the worker process
+  :type  worker: callable(int)
+
+  :returns: exit code
+  :rtype: int
+  """
+  workers = dict()
+  stopping = False
+  stop_signals = (signal.SIGTERM, signal.SIGINT)
+
+  def spawn(i):
+    # a signal is handled only once the worker is known to `stop`
+    signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+    try:
+      if stopping:
+        return
+
+      pid = os.fork()
+      if pid:
+        workers[pid] = i
+        return
+
+      code = 1
+      try:
+        for x in stop_signals:
+          signal.signal(x, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+        code = worker(i)
+      except BaseException:
+        traceback.print_exc()
+      finally:
+        os._exit(code)
+    finally:
+      signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+
+  def stop(signum, _):
+    nonlocal stopping
+    stopping = True
+    for pid in workers:
+      os.kill(pid, signum)
+
+  for x in stop_signals:
+    signal.signal(x, stop)
+
+  for i in range(n):
+    spawn(i)
+
+  while workers:
+    try:
+      pid, status = os.wait()
+    except ChildProcessError:
+      break
+
+    i = workers.pop(pid)
+    if stopping:
+      continue
+
+    print("Worker {} exited with status {}, restarting".format(i, status)
+    , file = sys.stderr
+    )
+    # do not spin if the workers keep crashing right away, `spawn` does
+    # nothing once a signal arrived meanwhile
+    time.sleep(1)
+    spawn(i)
+
+  return 0
+
+def run_worker(c, model, i):
+  """
+  Serves the application on its own event loop, sharing the listening
+  port with the other workers via SO_REUSEPORT. Stops gracefully on
+  SIGTERM or SIGINT.
+
+  :param i: worker number
+  :type  i: int
+
+  :returns: exit code
+  :rtype: int
+  """
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+
+  if c.spool_dir:
+    # segments are only ever written by a single process
+    c.spool_dir = os.path.join(c.spool_dir, str(i))
+
+  app = create_app(c, model, setup_schema = False)
+  handler = app.make_handler()
+  loop.run_until_complete(app.startup())
+  srv = loop.run_until_complete(loop.create_server(
+    handler, c.ip, c.port, reuse_port = True
+  ))
+
+  for x in (signal.SIGTERM, signal.SIGINT):
+    loop.add_signal_handler(x, loop.stop)
+
+  try:
+    loop.run_forever()
+  finally:
+    srv.close()
+    loop.run_until_complete(srv.wait_closed())
+    loop.run_until_complete(app.shutdown())
+    loop.run_until_complete(handler.finish_connections(60.0))
+    loop.run_until_complete(app.cleanup())
+    loop.close()
+
   return 0
 
 def transitions(args, loop, c, model):
   """
   Display page transitions graph
   """
-  e = model.connect(c.dsn)
+  e = c.connect()
 
   exit_state = 0
-  tgs = loop.run_until_complete(
-    model.get_transitions(e, exit_state)
-  )
 
   if args.session_id:
-    if args.session_id not in tgs:
+    tg = loop.run_until_complete(
+      model.get_session_transitions(e, args.session_id, exit_state)
+    )
+
+    if tg is None:
       print("Unknown session {!r}".format(args.session_id))
       return 1
 
-    tg = tgs[args.session_id]
-    tg.compute_probabilities()
-
     print("Transitions for session {}:\n".format(args.session_id))
-    tg.draw_transitions()
+    show_transitions(args, tg)
 
   else:
-    g = markov.Graph()
-    for tg in tgs.values():
-      g.add_weights(tg)
-    g.compute_probabilities()
+    g = loop.run_until_complete(
+      get_aggregated_transitions(args, c, model, e, exit_state)
+    ).to_graph()
 
     print("Aggregated transitions:\n")
-    g.draw_transitions()
+    show_transitions(args, g)
+
+def show_transitions(args, g):
+  """
+  Prints the transitions graph in the form selected by the arguments.
+
+  :param g:
+  :type  g: markov.Graph
+  """
+  if args.stationary:
+    print_states(
+      g, g.stationary()[1:], "{:6.2f} %", 100, args.top_k, offset = 1
+    )
+
+  elif args.reach is not None:
+    print_states(g, g.reach(args.reach)[0], "{:6.2f} %", 100, args.top_k)
+
+  elif args.session_length:
+    lengths = g.session_lengths().tolist()
+    entries = g.entries().tolist()
+    print("Expected session length: {:.2f}\n".format(
+      sum(x * y for x, y in zip(entries, lengths) if x)
+    ))
+    print_states(g, lengths[1:], "{:8.2f}", 1, args.top_k, offset = 1)
+
+  else:
+    g.draw_transitions(top_k = args.top_k)
+
+def print_states(g, values, fmt, scale, top_k, offset = 0):
+  """
+  Prints `values` of `g.states` starting from `offset` in descending
+  order.
+  """
+  states = g.states[offset:]
+  labels = [
+    'exit' if x == g.exit_state else str(x)
+    for x in states
+  ]
+  width = max([len(x) for x in labels] + [0])
+
+  rows = sorted(
+    zip(list(values), range(len(labels)))
+  , key = lambda x: (-x[0], x[1])
+  )
+  for value, i in rows[:top_k]:
+    print(labels[i].rjust(width), fmt.format(value * scale))
+
+async def get_aggregated_transitions(args, c, model, e, exit_state):
+  """
+  :returns: aggregated transitions from the source selected by the
+    arguments and config
+  :rtype: markov.Counts
+  """
+  if args.streaming:
+    return await model.fold_transitions(e, exit_state, c.fetch_size)
+
+  if c.track_transitions:
+    return await model.get_transition_counts(e)
+
+  if c.transitions_cache:
+    tc = cache.TransitionCache.load(c.transitions_cache)
+    await model.update_transition_cache(e, tc, c.fetch_size)
+    tc.prune(c.session_idle)
+    tc.save(c.transitions_cache)
+    return tc.counts
+
+  return await model.get_aggregated_transitions(e, exit_state)
+
+def paths(args, loop, c, model):
+  """
+  Display the most common paths through the pages
+  """
+  if args.order < 2:
+    print("A path has at least 2 pages")
+    return 1
+
+  ps = loop.run_until_complete(model.count_paths(
+    c.connect(), args.order, args.max_paths, c.fetch_size
+  ))
+
+  rows = [
+    (str(n), " -> ".join('exit' if x == ps.exit_state else str(x) for x in p))
+    for p, n in ps.top(args.top)
+  ]
+  width = max([len(n) for n, _ in rows] + [0])
+
+  for n, p in rows:
+    print(n.rjust(width), p)
 
 def sessions(args, loop, c, model):
   """
   List sessions in descending order by time of latest hit.
   """
   xs = loop.run_until_complete(
-    model.get_sessions(model.connect(c.dsn))
+    model.get_sessions(c.connect())
   )
   print("{0:<38} {1}".format("Session id", "Total Hits"))
   for x in xs:
     print("{}   {}".format(x.session_id, x.hits))
 
+def close_sessions(args, loop, c, model):
+  """
+  Count exits of idle sessions into the tracked transitions.
+  """
+  idle = c.session_idle if args.idle is None else args.idle
+  n = loop.run_until_complete(model.close_sessions(c.connect(), idle))
+  print("Closed {} sessions".format(n))
+
+def repair_transitions(args, loop, c, model):
+  """
+  Recount the tracked transitions from all hits.
+  """
+  loop.run_until_complete(model.rebuild_transition_counts(c.connect()))
+
+def partitions(args, loop, c, model):
+  """
+  Create upcoming partitions of the hits table and drop old ones.
+  """
+  if not c.partition_by:
+    print("Partitioning is not configured")
+    return 1
+
+  e = c.connect()
+  for x in loop.run_until_complete(model.create_partitions(
+    e, c.partition_by, c.partition_size, args.ahead
+  )):
+    print("Partition {}".format(x))
+
+  if args.drop_before is not None:
+    for x in loop.run_until_complete(
+      model.drop_partitions(e, args.drop_before)
+    ):
+      print("Dropped {}".format(x))
+
 def flatten(xs):
   """
   The flat part of flatMap
@@ -9,50 +9,185 @@ import itertools
 import networkx as nx
 import numpy as np
 import re
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse import linalg
 
 # I don't have a math degree but I know a markov chain when I see one.
 
 class Graph(nx.DiGraph):
   """
-  .. warning::
+  Nodes are the pages, which may be any sortable objects, and the exit
+  state `exit_state`.
+
+  The rows and columns of the matrix correspond to `states`, so its
+  size depends only on the number of distinct pages.
 
-    Works only with numeric nodes. `0` must represent exit state.
+  >>> g = Graph.from_edges([('/a', '/b'), ('/b', 0), (1000000, 0)])
+  >>> g.states
+  [0, 1000000, '/a', '/b']
+  >>> g.create_matrix().shape
+  (4, 4)
   """
   exit_state = 0
 
-  # FIXME: make the graph work with any nodes
+  # graphs with more states are drawn without the padding, see
+  # `_draw_transitions`
+  max_padded_size = 32
+
   # FIXME: remove the construction helpers.
   #        See nx.convert.to_network_graph.
-  #        Also probably related to the:
-  # FIXME: add possibility for automatic probability recalculation
+
+  def __init__(g, *args, **kwargs):
+    # derived data, see `invalidate`
+    g._cache = dict()
+    # node: sum of the weights of its outgoing edges
+    g._totals = dict()
+    # nodes whose outgoing edges' probabilities are out of date
+    g._stale = set()
+    super().__init__(*args, **kwargs)
+
+  def invalidate(g):
+    """
+    Forgets the matrix and other data derived from the graph.
+
+    Done automatically by the methods changing the graph, has to be
+    called after changing the edge data directly.
+    """
+    g._cache.clear()
+    g._totals = dict(
+      (u, sum(data.get('weight', 1) for data in vs.values()))
+      for u, vs in g.succ.items()
+    )
+    g._stale = set(g._totals)
 
   def compute_probabilities(g):
     """
     Populates the edge `(u, v)` data with `probability` field
     indicating the probability of transition from `u` to `v`.
 
-    .. warning::
+    The sums of the weights of outgoing edges are maintained as the
+    graph changes, so only the edges of nodes changed since the last
+    call are updated. `probabilities` and the methods reading the
+    probabilities call this automatically.
+    """
+    for u in g._stale:
+      g._normalize(u)
+
+    g._stale.clear()
 
-      Once the graph is manipulated again, the probabilities do not
-      reflect the new state.
+  def probabilities(g, u):
     """
-    totals = dict([(x, 0) for x in g.nodes()])
+    :returns: probability of the transition to each successor of `u`
+    :rtype: {object: float}
 
-    for u, v in g.edges_iter():
-      totals[u] += g[u][v]['weight']
+    >>> g = Graph.from_weighted_edges([(1, 2, 1), (1, 0, 3)])
+    >>> sorted(g.probabilities(1).items())
+    [(0, 0.75), (2, 0.25)]
+    >>> g.add_weights(Graph.from_weighted_edges([(1, 2, 4)]))
+    >>> sorted(g.probabilities(1).items())
+    [(0, 0.375), (2, 0.625)]
+    """
+    if u in g._stale:
+      g._normalize(u)
+      g._stale.discard(u)
+
+    return dict((v, data['probability']) for v, data in g.succ[u].items())
 
-    for u, v in g.edges_iter():
-      g[u][v]['probability'] = g[u][v]['weight'] / float(totals[u])
+  def _normalize(g, u):
+    if u not in g.succ:
+      return
+
+    total = float(g._totals[u])
+    for data in g.succ[u].values():
+      data['probability'] = data.get('weight', 1) / total if total else 0.0
+
+  def _reweigh(g, u, delta):
+    """
+    Accounts for the change of weights of the edges from `u`.
+    """
+    g._cache.clear()
+    g._totals[u] = g._totals.get(u, 0) + delta
+    g._stale.add(u)
+
+  def _weight(g, u, v):
+    """
+    :returns: weight of edge `(u, v)`, 0 if there is none
+    """
+    if u in g.succ and v in g.succ[u]:
+      return g.succ[u][v].get('weight', 1)
+
+    return 0
+
+  def add_node(g, n, *args, **kwargs):
+    g._cache.clear()
+    super().add_node(n, *args, **kwargs)
+
+  def add_nodes_from(g, nodes, *args, **kwargs):
+    g._cache.clear()
+    super().add_nodes_from(nodes, *args, **kwargs)
+
+  def add_edge(g, u, v, *args, **kwargs):
+    old = g._weight(u, v)
+    super().add_edge(u, v, *args, **kwargs)
+    g._reweigh(u, g._weight(u, v) - old)
+
+  def add_edges_from(g, ebunch, attr_dict = None, **attr):
+    # edge by edge to keep track of the weights
+    for e in ebunch:
+      data = dict(attr_dict or {}, **attr)
+      if len(e) == 3:
+        data.update(e[2])
+
+      g.add_edge(e[0], e[1], data)
+
+  def remove_edge(g, u, v):
+    weight = g._weight(u, v)
+    super().remove_edge(u, v)
+    g._reweigh(u, -weight)
+
+  def remove_edges_from(g, ebunch):
+    for e in ebunch:
+      if g.has_edge(e[0], e[1]):
+        g.remove_edge(e[0], e[1])
+
+  def remove_node(g, n):
+    preds = [(u, g._weight(u, n)) for u in g.predecessors(n)] \
+      if n in g else []
+
+    super().remove_node(n)
+    g._cache.clear()
+
+    for u, weight in preds:
+      if u != n:
+        g._reweigh(u, -weight)
+
+    g._totals.pop(n, None)
+    g._stale.discard(n)
+
+  def remove_nodes_from(g, nbunch):
+    for n in list(nbunch):
+      if n in g:
+        g.remove_node(n)
+
+  def clear(g):
+    super().clear()
+    g._cache.clear()
+    g._totals.clear()
+    g._stale.clear()
+
+  def subgraph(g, nbunch):
+    # built without the methods above
+    h = super().subgraph(nbunch)
+    h.invalidate()
+    return h
 
   @classmethod
   def from_multidigraph(cls, mdg):
     # http://stackoverflow.com/questions/15590812/networkx-convert-multigraph-into-simple-graph-with-weighted-edges
     g = cls()
     for u, v, data in mdg.edges_iter(data = True):
-        if g.has_edge(u, v):
-          g[u][v]['weight'] += 1
-        else:
-          g.add_edge(u, v, weight=1)
+        g.add_edge(u, v, weight = g._weight(u, v) + 1)
 
     return g
 
@@ -60,6 +195,18 @@ class Graph(nx.DiGraph):
   def from_edges(cls, xs):
     return cls.from_multidigraph(nx.MultiDiGraph(xs))
 
+  @classmethod
+  def from_weighted_edges(cls, xs):
+    """
+    :param xs: transitions with their counts
+    :type  xs: [(object, object, int)]
+    """
+    g = cls()
+    for u, v, n in xs:
+      g.add_edge(u, v, weight = n)
+
+    return g
+
   def add_weights(g, g2):
     """
     Adds weights from `g2` to self.
@@ -69,72 +216,324 @@ class Graph(nx.DiGraph):
     :type  g2: nx.Graph
     """
     for u, v, data in g2.edges_iter(data = True):
-      if not g.has_edge(u, v):
-        g.add_edge(u, v, weight = 0)
+      g.add_edge(u, v, weight = g._weight(u, v) + data['weight'])
+
+  @property
+  def states(g):
+    """
+    Cached until the graph changes.
+
+    :returns: nodes in the order of the matrix rows, the exit state
+      first and the pages sorted
+    :rtype: [object]
+    """
+    if 'states' not in g._cache:
+      pages = [x for x in g.nodes() if x != g.exit_state]
+      g._cache['states'] = [g.exit_state] + sorted(pages, key = _node_key)
 
-      g[u][v]['weight'] += data['weight']
+    return g._cache['states']
+
+  @property
+  def index(g):
+    """
+    :returns: row of each node in the matrix
+    :rtype: {object: int}
+    """
+    if 'index' not in g._cache:
+      g._cache['index'] = dict((x, i) for i, x in enumerate(g.states))
+
+    return g._cache['index']
 
   @property
   def size(g):
     """
     :returns: Size of the matrix needed for this graph
     """
-    return g.nodes()[-1] + 1
+    return len(g.states)
 
   def create_matrix(g):
     """
-    :returns: Markov matrix. The probabilities must be pre-calculated.
+    The matrix is cached until the graph changes, see `invalidate`.
+
+    :returns: Markov matrix with rows and columns ordered as `states`
     :rtype: np.array
     """
-    for n in g.nodes():
-      assert isinstance(n, int), "Non-numeric nodes are not supported"
+    if 'matrix' not in g._cache:
+      u, v, p = g._transitions()
+      mm = np.zeros([g.size, g.size])
+      mm[u, v] = p
+      g._cache['matrix'] = mm
 
-    # group by current state
-    es = itertools.groupby(g.edges(data = True), lambda e: e[0])
+    return g._cache['matrix']
 
-    mm = np.zeros([g.size, g.size])
-    for u, v in g.edges_iter():
-      mm[u][v] = g[u][v]['probability']
+  def _transitions(g):
+    """
+    Sparse form of the matrix. Cached until the graph changes, see
+    `invalidate`.
 
-    return mm
+    :returns: `index` of the sources and targets of the transitions and
+      their probabilities sorted by the sources
+    :rtype: (np.array, np.array, np.array)
+    """
+    if 'transitions' not in g._cache:
+      g.compute_probabilities()
+      es = g.edges(data = True)
+      index = g.index
+      u = np.array([index[x[0]] for x in es], dtype = np.int64)
+      order = np.argsort(u, kind = 'mergesort')
+
+      g._cache['transitions'] = (
+        u[order]
+      , np.array([index[x[1]] for x in es], dtype = np.int64)[order]
+      , np.array([x[2]['probability'] for x in es], dtype = float)[order]
+      )
+
+    return g._cache['transitions']
+
+  def entries(g):
+    """
+    Estimates where the sessions start from the difference of the views
+    of each page and the transitions into it from other pages.
+
+    :returns: probability of each of `states` being the first page of a
+      session
+    :rtype: np.array
+    """
+    index = g.index
+    e = np.zeros(g.size)
+    for u, vs in g.succ.items():
+      for v, data in vs.items():
+        e[index[u]] += data.get('weight', 1)
+        e[index[v]] -= data.get('weight', 1)
+
+    e[0] = 0
+    e = np.maximum(e, 0)
+    if not e.sum():
+      # every page is entered from another one, eg. a single session
+      # graph without its first page view
+      e[1:] = 1
+
+    return e / e.sum() if e.sum() else e
+
+  def stationary(g, tol = 1e-10, max_iter = 100000):
+    """
+    Long-run share of the page views of each page, when every exit is
+    followed by a new session starting according to `entries`.
+
+    Computed by lazy power iteration over the sparse transitions.
+
+    :returns: probability of each of `states`, 0 for the exit state
+    :rtype: np.array
+
+    >>> g = Graph.from_weighted_edges([(1, 2, 1), (2, 0, 1)])
+    >>> g.stationary().round(3).tolist()
+    [0.0, 0.5, 0.5]
+    """
+    entries = g.entries()
+    x = entries
+    for _ in range(max_iter):
+      y = g._propagate(x[None])[0]
+      y += y[0] * entries
+      y[0] = 0
+
+      # lazy step, so periodic chains converge too
+      y = (x + y) / 2
+      if y.sum():
+        y /= y.sum()
 
-  def draw_transitions(g, writeln = print):
+      if np.abs(y - x).sum() < tol:
+        return y
+
+      x = y
+
+    return x
+
+  def reach(g, steps, sources = None):
+    """
+    :param steps: number of transitions
+    :type  steps: int
+
+    :param sources: pages to start from. Sessions start according to
+      `entries` if None.
+    :type  sources: [object]
+
+    :returns: for each source (rows) the probability of being at each of
+      `states` (columns) after `steps` transitions. The exit state is
+      absorbing, so its column is the probability that the session has
+      ended by then.
+    :rtype: np.array
+
+    >>> g = Graph.from_weighted_edges([(1, 2, 1), (1, 0, 1), (2, 0, 1)])
+    >>> g.reach(1, [1, 2]).tolist()
+    [[0.5, 0.0, 0.5], [1.0, 0.0, 0.0]]
+    """
+    if sources is None:
+      x = g.entries()[None]
+    else:
+      x = np.zeros([len(sources), g.size])
+      x[np.arange(len(sources)), [g.index[s] for s in sources]] = 1
+
+    for _ in range(steps):
+      exited = x[:, 0].copy()
+      x = g._propagate(x)
+      x[:, 0] += exited
+
+    return x
+
+  def session_lengths(g, tol = 1e-10, max_restarts = 100):
+    """
+    Expected number of page views of a session from each page on,
+    including the page. Solves `(I - Q) t = 1` for the transitions `Q`
+    between the pages whose sessions surely end, with the exit state
+    absorbing. Weight the result by `entries` for the expected length
+    of sessions.
+
+    The system is solved by restarted GMRES, which needs a sparse
+    product per iteration, or directly if the residual is still over
+    `tol` after `max_restarts` restarts. A direct solution may take long
+    on large densely linked graphs.
+
+    :param tol: relative residual the iterative solution stops at
+    :type  tol: float
+
+    :param max_restarts: maximum number of restarts before solving
+      directly
+    :type  max_restarts: int
+
+    :returns: expected number of page views for each of `states`,
+      0 for the exit state and inf for pages whose sessions may never end
+    :rtype: np.array
+
+    >>> g = Graph.from_weighted_edges([(1, 2, 1), (2, 3, 1), (3, 0, 1)])
+    >>> g.session_lengths().round(6).tolist()
+    [0.0, 3.0, 2.0, 1.0]
+    >>> g.add_weighted_edges_from([(1, 1, 3), (2, 4, 1), (4, 4, 1)])
+    >>> g.session_lengths().round(6).tolist()
+    [0.0, inf, inf, 1.0, inf]
+    """
+    u, v, p = g._transitions()
+    out = u != 0
+    u, v, p = u[out], v[out], p[out]
+
+    # sessions surely end unless a page which can not exit is reachable
+    exits = _reaching(u, v, [0], g.size)
+    finite = ~_reaching(u, v, np.flatnonzero(~exits), g.size)
+    finite[0] = False
+
+    t = np.full(g.size, np.inf)
+    t[0] = 0
+
+    pages = np.flatnonzero(finite)
+    if len(pages):
+      pos = np.cumsum(finite) - 1
+      inner = finite[u] & finite[v]
+      q = sparse.csc_matrix(
+        (p[inner], (pos[u[inner]], pos[v[inner]]))
+      , shape = (len(pages), len(pages))
+      )
+      a = sparse.identity(len(pages), format = 'csc') - q
+      b = np.ones(len(pages))
+
+      try:
+        x, _ = linalg.gmres(a, b, rtol = tol, maxiter = max_restarts)
+      except TypeError: # scipy < 1.12
+        x, _ = linalg.gmres(a, b, tol = tol, maxiter = max_restarts)
+
+      # the solvers may report success on breakdown
+      if np.linalg.norm(a.dot(x) - b) > tol * np.linalg.norm(b):
+        x = linalg.spsolve(a, b)
+
+      t[pages] = x
+
+    return t
+
+  def _propagate(g, x):
+    """
+    Multiplies the rows of `x` by the matrix.
+
+    :param x: probability of each of `states` (columns)
+    :type  x: np.array
+
+    :rtype: np.array
+    """
+    if 'by_target' not in g._cache:
+      u, v, p = g._transitions()
+      order = np.argsort(v, kind = 'mergesort')
+      v = v[order]
+
+      first = np.ones(len(v), dtype = bool)
+      first[1:] = v[1:] != v[:-1]
+      starts = np.flatnonzero(first)
+
+      g._cache['by_target'] = (u[order], p[order], starts, v[starts])
+
+    u, p, starts, targets = g._cache['by_target']
+
+    y = np.zeros(x.shape)
+    if len(u):
+      y[:, targets] = np.add.reduceat(x[:, u] * p, starts, axis = 1)
+
+    return y
+
+  def draw_transitions(g, writeln = print, top_k = None):
     """
     Draws transitions in the form of ASCII block diagram.
+
+    :param top_k: maximum number of the most probable transitions drawn
+      from each state. All of them if None. The states are separated by
+      a single empty line if given.
+    :type  top_k: int
+    """
+    u, v, p = g._transitions()
+    size = g.size
+
+    sums = np.bincount(u, weights = p, minlength = size)
+    starts = np.searchsorted(u, np.arange(size + 1))
+
+    for i in (np.flatnonzero(sums[1:size]) + 1).tolist():
+      lo, hi = starts[i], starts[i + 1]
+      g._draw_transitions(i, v[lo:hi], p[lo:hi], size, top_k, writeln)
+
+  def _draw_transitions(g, current, vs, ps, size, top_k, writeln):
     """
-    for i in range(1, g.size):
-      g._draw_transitions(i, writeln)
+    :param current: `index` of the state
+    :type  current: int
+
+    :param vs: `index` of the targets of the transitions from `current`
+    :type  vs: np.array
+
+    :param ps: probabilities of the transitions
+    :type  ps: np.array
 
-  def _draw_transitions(g, current, writeln):
+    :param size: see `size`
+    """
     # FIXME: find a graphing library. I could find only perls
     # Graph::Easy.
     # Turns out networkx can draw the graphs via matplotlib or
     # graphviz so an ascii graphing/converting could work from that
-    assert current != g.exit_state \
+    states = g.states
+    label = states[current]
+    assert label != g.exit_state \
     , "Can not have a transition from exit state"
 
-    mm = g.create_matrix()
-    if len(mm) <= current or sum(mm[current]) == 0:
-      return
-
     # FIXME: either remove transitions `Si -> Si` from the probability
     # calculation or display them too
+    drawn = (vs != current) & (ps != 0)
+    vs, ps = vs[drawn], ps[drawn]
 
-    def gen(mm, current, next):
-      return dict(
-        next = next if next != 0 else 'exit'
-      , p = mm[current][next] * 100
-      )
-
-    def draw_block(data, prefix = '\n'):
-      if(data['p'] == 0):
-        return ""
+    if top_k is not None and len(vs) > top_k:
+      top = np.argsort(-ps, kind = 'mergesort')[:top_k]
+      vs, ps = vs[top], ps[top]
 
-      data['next_len'] = "-" * len(str(data['next']))
+    def draw_block(next, p, prefix = '\n'):
+      next = states[next] if next != 0 else 'exit'
       return prefix + """                    +-{next_len}-+
  --- {p:3.0f} % --->     | {next} |
-                    +-{next_len}-+""".format(**data)
-
+                    +-{next_len}-+""".format(
+        next = next
+      , p = p * 100
+      , next_len = "-" * len(str(next))
+      )
 
     def join(left, right):
       out = []
@@ -156,17 +555,546 @@ class Graph(nx.DiGraph):
         for x in xs.splitlines()
       ])
 
-    states = list(set(range(1, len(mm))) - set([current])) + [0]
-
     current_tpl = """+-{cur_len}-+
 | {current} |
 +-{cur_len}-+
-""".format(current = current, cur_len = "-" * len(str(current)))
+""".format(current = label, cur_len = "-" * len(str(label)))
+
+    blocks = sorted(
+      [draw_block(x, y) for x, y in zip(vs.tolist(), ps.tolist())]
+    , reverse = True
+    )
+
+    writeln(join(current_tpl, blocks[0] if blocks else ""))
+
+    for x in blocks[1:]:
+      writeln(indent(len(str(label)) + 4, x))
+
+    if top_k is not None or size > g.max_padded_size:
+      writeln("")
+      return
+
+    # an empty line for each of the other states not drawn (states but
+    # `current` and exit, which takes its place)
+    empty = size - 1 - max(len(blocks), 1)
+    if empty > 0:
+      writeln("\n" * (empty - 1))
+
+def _node_key(x):
+  """
+  Sort key of nodes of different, mutually incomparable types.
+  """
+  return (type(x).__name__, x)
+
+class Counts:
+  """
+  Transition counts stored as COO arrays sorted by `(u, v)`, each
+  transition `u -> v` occurring at most once with count `n`.
+
+  Unlike `Graph`, merging and normalization are done on whole arrays
+  at once. Convert to `Graph` with `to_graph` for drawing.
+
+  .. warning::
+
+    Works only with integer nodes.
+
+  The matrix covers only the `states` which occur, so its size does not
+  depend on the largest page number.
+
+  >>> c = Counts.from_edges([(1, 2), (1, 2), (1, 0), (2, 0)])
+  >>> c.edges()
+  [(1, 0, 1), (1, 2, 2), (2, 0, 1)]
+  >>> (c + c).edges()
+  [(1, 0, 2), (1, 2, 4), (2, 0, 2)]
+  >>> c.compute_probabilities().tolist()
+  [0.3333333333333333, 0.6666666666666666, 1.0]
+  """
+  exit_state = Graph.exit_state
+
+  def __init__(c, u = (), v = (), n = None):
+    """
+    :param u: transition sources
+    :type  u: [int]
+
+    :param v: transition targets
+    :type  v: [int]
+
+    :param n: transition counts. One for each transition by default.
+      The same transition may occur repeatedly, its counts are summed.
+      Transitions whose counts sum up to zero are dropped.
+    :type  n: [int]
+    """
+    u = np.asarray(u, dtype = np.int64)
+    v = np.asarray(v, dtype = np.int64)
+    if n is None:
+      n = np.ones(len(u), dtype = np.int64)
+    else:
+      n = np.asarray(n, dtype = np.int64)
+
+    u, v, n = _sum_duplicates(u, v, n)
+    keep = n != 0
+    c.u, c.v, c.n = u[keep], v[keep], n[keep]
+
+  @classmethod
+  def from_edges(cls, xs):
+    """
+    :param xs: transitions, possibly repeated
+    :type  xs: [(int, int)]
+    """
+    xs = np.array(list(xs), dtype = np.int64).reshape(-1, 2)
+    return cls(xs[:, 0], xs[:, 1])
+
+  @classmethod
+  def from_sessions(cls, pages, sessions):
+    """
+    :param pages: visited pages sorted by session and then
+      chronologically
+    :type  pages: [int]
+
+    :param sessions: session of each page view
+    :type  sessions: [object]
+
+    >>> Counts.from_sessions([1, 3, 1], [1, 1, 2]).edges()
+    [(1, 0, 1), (1, 3, 1), (3, 0, 1)]
+    """
+    pages = np.asarray(pages, dtype = np.int64)
+    u, v = transitions(pages, session_ends(np.asarray(sessions)))
+    return cls(u, v)
+
+  @classmethod
+  def from_weighted_edges(cls, xs):
+    """
+    :param xs: transitions with their counts
+    :type  xs: [(int, int, int)]
+    """
+    xs = np.array(list(xs), dtype = np.int64).reshape(-1, 3)
+    return cls(xs[:, 0], xs[:, 1], xs[:, 2])
+
+  @classmethod
+  def from_graph(cls, g):
+    """
+    :param g: graph with weighted edges
+    :type  g: Graph
+    """
+    return cls.from_weighted_edges(
+      (u, v, data['weight']) for u, v, data in g.edges_iter(data = True)
+    )
+
+  def to_graph(c, cls = Graph):
+    """
+    :returns: graph with `weight` and `probability` of each edge set
+    :rtype: Graph
+    """
+    g = cls()
+    for u, v, n, p in zip(
+      c.u.tolist()
+    , c.v.tolist()
+    , c.n.tolist()
+    , c.compute_probabilities().tolist()
+    ):
+      g.add_edge(u, v, weight = n, probability = p)
+
+    return g
+
+  def __add__(c, c2):
+    """
+    :returns: counts of both `c` and `c2`
+    :rtype: Counts
+    """
+    return type(c)(
+      np.concatenate([c.u, c2.u])
+    , np.concatenate([c.v, c2.v])
+    , np.concatenate([c.n, c2.n])
+    )
+
+  def __len__(c):
+    return len(c.n)
+
+  def edges(c):
+    """
+    :rtype: [(int, int, int)]
+    """
+    return list(zip(c.u.tolist(), c.v.tolist(), c.n.tolist()))
+
+  @property
+  def states(c):
+    """
+    :returns: the exit state and the pages, in the order of the matrix
+      rows
+    :rtype: np.array
+
+    >>> Counts.from_edges([(7, 1000000), (1000000, 0)]).states.tolist()
+    [0, 7, 1000000]
+    """
+    return np.unique(np.concatenate([[c.exit_state], c.u, c.v]))
+
+  @property
+  def size(c):
+    """
+    :returns: Size of the matrix needed for these counts
+    """
+    return len(c.states)
+
+  def compute_probabilities(c):
+    """
+    :returns: probability of each transition, aligned with `edges`
+    :rtype: np.array
+    """
+    if not len(c):
+      return np.zeros(0)
+
+    # the transitions are sorted by their sources
+    first = np.ones(len(c.u), dtype = bool)
+    first[1:] = c.u[1:] != c.u[:-1]
+    starts = np.flatnonzero(first)
+
+    totals = np.add.reduceat(c.n, starts)
+    return c.n / np.repeat(totals, np.diff(np.append(starts, len(c.u))))
+
+  def create_matrix(c):
+    """
+    :returns: Markov matrix with rows and columns ordered as `states`
+    :rtype: np.array
+    """
+    states = c.states
+    mm = np.zeros([len(states), len(states)])
+    mm[
+      np.searchsorted(states, c.u)
+    , np.searchsorted(states, c.v)
+    ] = c.compute_probabilities()
+    return mm
+
+class Paths:
+  """
+  Counts of the paths of 2 to `order` page views taken in sessions. The
+  last page of a path may be the exit state, so the paths of 2 pages are
+  the transitions.
+
+  The paths are stored as rows of an array padded with `_pad`, which is
+  no valid node, along with their bytes, which identify them when
+  merging counts.
+
+  Once there are more than `max_paths` paths, the rarest ones are
+  forgotten along with their extensions. The counts of paths forgotten
+  and seen again later then miss the forgotten views.
+
+  .. warning::
+
+    Works only with integer nodes.
+
+  :param order: maximum number of pages of a path
+  :type  order: int
+
+  :param max_paths: None to keep any number of paths
+  :type  max_paths: int
+
+  >>> ps = Paths(3)
+  >>> ps.add_sessions([1, 2, 1, 2, 3], [7, 7, 8, 8, 8])
+  >>> ps.top(3)
+  [((1, 2), 2), ((1, 2, 0), 1), ((1, 2, 3), 1)]
+  >>> len(ps)
+  7
+  >>> ps.add_sessions([-1, 2, 2, -1], [9, 9, 10, 10])
+  >>> [path for path, _ in ps.top(length = 3)]
+  [(-1, 2, 0), (1, 2, 0), (1, 2, 3), (2, -1, 0), (2, 3, 0)]
+  """
+  exit_state = Graph.exit_state
+
+  _pad = np.iinfo(np.int64).min
+
+  def __init__(ps, order, max_paths = None):
+    assert order >= 2, "Paths have at least 2 pages"
+
+    ps.order = order
+    ps.max_paths = max_paths
+
+    ps.paths = np.zeros([0, order], dtype = np.int64)
+    ps.keys = _path_keys(ps.paths)
+    ps.n = np.zeros(0, dtype = np.int64)
+
+  def __len__(ps):
+    return len(ps.n)
 
-    blocks = sorted([draw_block(gen(mm, current, x)) for x in states])
-    blocks.reverse()
+  def add_sessions(ps, pages, sessions):
+    """
+    :param pages: visited pages sorted by session and then
+      chronologically. Each session must be complete.
+    :type  pages: [int]
+
+    :param sessions: session of each page view
+    :type  sessions: [object]
+    """
+    pages = np.asarray(pages, dtype = np.int64)
+    if not len(pages):
+      return
+
+    last = session_ends(np.asarray(sessions))
+
+    # page views followed by the exit of each session
+    views = np.empty(len(pages) + int(last.sum()), dtype = np.int64)
+    exits = np.flatnonzero(last) + np.arange(1, int(last.sum()) + 1)
+    is_view = np.ones(len(views), dtype = bool)
+    is_view[exits] = False
+    views[is_view] = pages
+    views[exits] = ps.exit_state
+
+    # index of the session of each view
+    codes = np.cumsum(~is_view) - ~is_view
+
+    paths = []
+    for length in range(2, ps.order + 1):
+      starts = np.flatnonzero(
+        codes[:len(views) - length + 1] == codes[length - 1:]
+      )
+      if not len(starts):
+        break
+
+      xs = np.full([len(starts), ps.order], ps._pad, dtype = np.int64)
+      for i in range(length):
+        xs[:, i] = views[starts + i]
+      paths.append(xs)
+
+    if paths:
+      paths = np.concatenate(paths)
+      ps._merge(paths, np.ones(len(paths), dtype = np.int64))
+
+  def top(ps, n = None, length = None):
+    """
+    :param n: number of paths. All of them if None.
+    :type  n: int
+
+    :param length: number of pages of the paths. Any if None.
+    :type  length: int
+
+    :returns: the most common paths with their counts
+    :rtype: [((int, ...), int)]
+    """
+    keep = np.ones(len(ps), dtype = bool) if length is None \
+      else _path_lengths(ps.paths) == length
+
+    paths, counts = ps.paths[keep], ps.n[keep]
+    order = np.lexsort(
+      [paths[:, i] for i in reversed(range(ps.order))] + [-counts]
+    )[:n]
+
+    return [
+      (tuple(x for x in path if x != ps._pad), count)
+      for path, count in zip(paths[order].tolist(), counts[order].tolist())
+    ]
+
+  def _merge(ps, paths, n):
+    paths = np.concatenate([ps.paths, paths])
+    keys = np.concatenate([ps.keys, _path_keys(paths[len(ps.paths):])])
+    n = np.concatenate([ps.n, n])
+
+    keys, first, i = np.unique(keys, return_index = True, return_inverse = True)
+    ps.keys = keys
+    ps.paths = paths[first]
+    ps.n = np.bincount(i.ravel(), weights = n, minlength = len(keys)) \
+      .astype(np.int64)
+
+    if ps.max_paths is not None and len(ps) > ps.max_paths:
+      ps._prune()
+
+  def _prune(ps):
+    """
+    Keeps the `max_paths` most common paths whose prefixes are kept too.
+    """
+    keep = np.zeros(len(ps), dtype = bool)
+    keep[np.argsort(-ps.n, kind = 'mergesort')[:ps.max_paths]] = True
+
+    lengths = _path_lengths(ps.paths)
+    prefixes = ps.paths.copy()
+    prefixes[np.arange(len(prefixes)), lengths - 1] = ps._pad
+    prefix_keys = _path_keys(prefixes)
+
+    for length in range(3, ps.order + 1):
+      extensions = keep & (lengths == length)
+      # keys are sorted by np.unique
+      kept = ps.keys[keep & (lengths == length - 1)]
+      if not len(kept):
+        keep[extensions] = False
+        continue
+
+      xs = prefix_keys[extensions]
+      i = np.minimum(np.searchsorted(kept, xs), len(kept) - 1)
+      keep[extensions] = kept[i] == xs
+
+    ps.keys, ps.paths, ps.n = ps.keys[keep], ps.paths[keep], ps.n[keep]
+
+def _reaching(u, v, targets, size):
+  """
+  :param u: sources of the transitions
+  :type  u: np.array
+
+  :param v: targets of the transitions
+  :type  v: np.array
+
+  :returns: mask of the states from which some of the `targets` are
+    reachable, the `targets` included
+  :rtype: np.array
+  """
+  # breadth first search from an extra state leading to the targets
+  # along the reversed transitions
+  targets = np.asarray(targets, dtype = np.int64)
+  m = sparse.csr_matrix(
+    ( np.ones(len(u) + len(targets))
+    , ( np.concatenate([v, np.full(len(targets), size)])
+      , np.concatenate([u, targets])
+      )
+    )
+  , shape = (size + 1, size + 1)
+  )
+  found = csgraph.breadth_first_order(
+    m, size, directed = True, return_predecessors = False
+  )
+
+  mask = np.zeros(size + 1, dtype = bool)
+  mask[found] = True
+  return mask[:size]
+
+def _path_lengths(paths):
+  """
+  :returns: number of pages of each of the padded `paths`
+  :rtype: np.array
+  """
+  return (paths != Paths._pad).sum(axis = 1)
+
+def _path_keys(paths):
+  """
+  :returns: bytes of each of the padded `paths`, equal only for equal
+    paths
+  :rtype: np.array
+  """
+  paths = np.ascontiguousarray(paths)
+  return paths.view(np.dtype((np.void, paths.itemsize * paths.shape[1]))) \
+    .ravel()
+
+def session_ends(sessions):
+  """
+  :param sessions: session of each page view, grouped by session
+  :type  sessions: np.array
+
+  :returns: mask of the last page view of each session
+  :rtype: np.array
+
+  >>> session_ends(np.array([1, 1, 2])).tolist()
+  [False, True, True]
+  """
+  last = np.ones(len(sessions), dtype = bool)
+  last[:-1] = sessions[1:] != sessions[:-1]
+  return last
+
+def transitions(pages, last, exit_state = Graph.exit_state):
+  """
+  :param pages: visited pages grouped by session, chronologically
+  :type  pages: np.array
+
+  :param last: as returned by `session_ends`
+  :type  last: np.array
+
+  :returns: `(pages, next_pages)` where the next page of the last page
+    view of a session is `exit_state`
+  :rtype: (np.array, np.array)
+
+  >>> u, v = transitions(np.array([1, 3, 1]), np.array([False, True, True]))
+  >>> v.tolist()
+  [3, 0, 0]
+  """
+  next_pages = np.empty_like(pages)
+  next_pages[:-1] = pages[1:]
+  next_pages[last] = exit_state
+  return pages, next_pages
+
+def session_transitions(pages, sessions, exit_state = Graph.exit_state):
+  """
+  Counts transitions of each session separately.
+
+  :param pages: visited pages sorted by session and then
+    chronologically
+  :type  pages: np.array
+
+  :param sessions: session of each page view
+  :type  sessions: np.array
+
+  :returns: `(sessions, u, v, n)` sorted by session and then `(u, v)`
+  :rtype: (np.array, np.array, np.array, np.array)
+
+  >>> xs = session_transitions(np.array([1, 3, 1]), np.array([7, 7, 8]))
+  >>> [x.tolist() for x in xs]
+  [[7, 7, 8], [1, 3, 1], [3, 0, 0], [1, 1, 1]]
+  """
+  if not len(pages):
+    return sessions, pages, pages, pages
+
+  last = session_ends(sessions)
+  u, v = transitions(pages, last, exit_state)
+
+  # index of the session of each page view
+  codes = np.cumsum(last) - last
+
+  (codes, u, v), n = _group_sum(
+    [codes, u, v]
+  , np.ones(len(u), dtype = np.int64)
+  )
+  return sessions[last][codes], u, v, n
+
+# largest `size ** 2` for which the transitions are counted in a dense
+# array
+_max_dense = 1 << 22
+
+def _sum_duplicates(u, v, n):
+  """
+  :returns: `(u, v, n)` sorted by `(u, v)` with counts of repeated
+    transitions summed
+
+  >>> u, v, n = _sum_duplicates(
+  ...   np.array([1, -1, 1]), np.array([-1, 0, -1]), np.array([1, 1, 1])
+  ... )
+  >>> u.tolist(), v.tolist(), n.tolist()
+  ([-1, 1], [0, -1], [1, 2])
+  >>> u, v, n = _sum_duplicates(
+  ...   np.array([1, -5000]), np.array([-1, 5000]), np.array([1, 1])
+  ... )
+  >>> u.tolist(), v.tolist(), n.tolist()
+  ([-5000, 1], [5000, -1], [1, 1])
+  """
+  if not len(u):
+    return u, v, n
+
+  # shifted so the keys below are non-negative
+  lo = int(min(u.min(), v.min()))
+  size = int(max(u.max(), v.max())) - lo + 1
+  if size > 1 << 31:
+    (u, v), n = _group_sum([u, v], n)
+    return u, v, n
+
+  keys = (u - lo) * size + (v - lo)
+  if size * size <= _max_dense:
+    n = np.bincount(keys, weights = n, minlength = size * size)
+    keys = np.flatnonzero(n)
+    n = n[keys]
+  else:
+    keys, i = np.unique(keys, return_inverse = True)
+    n = np.bincount(i.ravel(), weights = n, minlength = len(keys))
+
+  return keys // size + lo, keys % size + lo, n.astype(np.int64)
+
+def _group_sum(keys, n):
+  """
+  :param keys: key columns, the first one is the most significant
+  :type  keys: [np.array]
+
+  :returns: `(keys, n)` sorted by keys with the `n` of equal keys summed
+  """
+  i = np.lexsort(keys[::-1])
+  keys = [x[i] for x in keys]
+  n = n[i]
 
-    writeln(join(current_tpl, blocks.pop(0)))
+  first = np.zeros(len(n), dtype = bool)
+  first[0] = True
+  for x in keys:
+    first[1:] |= x[1:] != x[:-1]
+  starts = np.flatnonzero(first)
 
-    while len(blocks):
-      writeln(indent(len(str(current)) + 4, blocks.pop(0)))
+  return [x[starts] for x in keys], np.add.reduceat(n, starts)
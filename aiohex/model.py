@@ -5,10 +5,20 @@ Databse accessors / helpers
 """
 
 import asyncio
+import collections
+import hashlib
 import io
 import itertools
+import json
+import logging
+import operator
+import random
+import re
 import sys
+import uuid
+import weakref
 
+import numpy as np
 import sqlalchemy as sa
 from sqlalchemy import sql
 from sqlalchemy.dialects import postgresql as pgdia
@@ -16,35 +26,238 @@ from aiopg.sa import create_engine
 
 from . import markov
 
+log = logging.getLogger(__name__)
+
 metadata = sa.MetaData()
 
-hits = sa.Table(
-  'hits'
+def _hits_table(metadata, partition_by = None):
+  """
+  :param partition_by: column to range partition the table by if any.
+    One of `partition_columns`.
+  :type  partition_by: str
+
+  :rtype: sa.Table
+  """
+  return sa.Table(
+    'hits'
+  , metadata
+  , sa.Column('id'        , sa.Integer      , primary_key = True
+    , autoincrement = True
+    )
+  , sa.Column('page_no'   , sa.Integer      , nullable = False)
+  , sa.Column('session_id', pgdia.UUID(True), nullable = False)
+  , sa.Column('ip'        , pgdia.INET      , nullable = False)
+  , sa.Column('socket'    , sa.Integer      , nullable = False)
+    # captured according to `HeaderPolicy` by older versions, see
+    # header_set
+  , sa.Column('headers'   , pgdia.JSONB     , nullable = True)
+    # `fingerprint` of the `header_sets` row, NULL if no headers were
+    # captured
+  , sa.Column('header_set', sa.BigInteger   , nullable = True)
+    # partitioning columns must be part of the primary key
+  , sa.Column('created'   , sa.DateTime(timezone = True), nullable = False
+    , server_default = sql.func.now()
+    , primary_key = partition_by == 'created'
+    )
+  , postgresql_partition_by =
+      'RANGE ({})'.format(partition_by) if partition_by else None
+  )
+
+partition_columns = ('id', 'created')
+
+hits = _hits_table(metadata)
+
+# Maintained by the `count_transition` trigger if enabled by
+# `connect(track_transitions = True)`.
+transition_counts = sa.Table(
+  'transition_counts'
+, metadata
+, sa.Column('from_page', sa.Integer   , primary_key = True)
+, sa.Column('to_page'  , sa.Integer   , primary_key = True)
+, sa.Column('n'        , sa.BigInteger, nullable = False)
+)
+
+# Latest page of each session which was not closed yet.
+session_heads = sa.Table(
+  'session_heads'
 , metadata
-, sa.Column('id'        , sa.Integer      , primary_key = True)
+, sa.Column('session_id', pgdia.UUID(True), primary_key = True)
 , sa.Column('page_no'   , sa.Integer      , nullable = False)
-, sa.Column('session_id', pgdia.UUID(True), nullable = False)
-, sa.Column('ip'        , pgdia.INET      , nullable = False)
-, sa.Column('socket'    , sa.Integer      , nullable = False)
-, sa.Column('headers'   , sa.Text         , nullable = False)
+, sa.Column('last_seen' , sa.DateTime(timezone = True), nullable = False
+  , server_default = sql.func.now()
+  )
+)
+
+# Distinct sets of headers captured with the hits.
+header_sets = sa.Table(
+  'header_sets'
+, metadata
+, sa.Column('fingerprint', sa.BigInteger, primary_key = True)
+, sa.Column('headers'    , pgdia.JSONB  , nullable = False)
 )
-# TODO: use more reasonable format for headers
-# TODO: more browser fingerprinting.
+
+schema_version = sa.Table(
+  'schema_version'
+, metadata
+, sa.Column('version', sa.Integer, nullable = False)
+)
+
+# TODO: more browser fingerprinting, on top of `header_sets`.
 #       http://anoncheck.security-portal.cz/ is a good reference for
 #       starters
 #       and here probably are further hints
 #       https://panopticlick.eff.org/about#methodology
 
-def connect(dsn):
+def connect(
+  dsn
+, *
+, track_transitions = False
+, partition_by      = None
+, pool_minsize      = 1
+, pool_maxsize      = 10
+, acquire_timeout   = None
+, statement_timeout = None
+, prepare           = True
+, setup_schema      = True
+):
   """
   :param dsn:
   :type dsn: DSN
 
-  :returns: aiopg.sa.Engine
+  :param track_transitions: maintain `transition_counts` on every hit
+  :type  track_transitions: bool
+
+  :param partition_by: see `create_tables`
+
+  :param pool_minsize: number of connections opened upfront
+  :type  pool_minsize: int
+
+  :param pool_maxsize: maximum number of open connections
+  :type  pool_maxsize: int
+
+  :param acquire_timeout: see `Engine`
+
+  :param statement_timeout: seconds after which the server aborts a
+    statement. None for the server's default.
+  :type  statement_timeout: float
+
+  :param prepare: see `Engine`
+
+  :param setup_schema: run `create_tables` first
+  :type  setup_schema: bool
+
+  :rtype: Engine
   """
-  _create_tables(dsn)
-  return asyncio.get_event_loop() \
-    .run_until_complete(create_engine(dsn))
+  if setup_schema:
+    create_tables(
+      dsn
+    , track_transitions = track_transitions
+    , partition_by      = partition_by
+    )
+
+  kwargs = dict()
+  if statement_timeout is not None:
+    kwargs['options'] = '-c statement_timeout={:d}'.format(
+      int(statement_timeout * 1000)
+    )
+
+  engine = asyncio.get_event_loop().run_until_complete(create_engine(
+    dsn
+  , minsize = pool_minsize
+  , maxsize = pool_maxsize
+  , **kwargs
+  ))
+  return Engine(engine, acquire_timeout = acquire_timeout, prepare = prepare)
+
+class Engine:
+  """
+  aiopg.sa.Engine which limits the time spent waiting for a connection
+  and keeps statistics of the pool.
+
+  :param engine:
+  :type  engine: aiopg.sa.Engine
+
+  :param acquire_timeout: seconds after which waiting for a connection
+    raises asyncio.TimeoutError. None to wait indefinitely.
+  :type  acquire_timeout: float
+
+  :param prepare: insert hits using a server-side prepared statement.
+    Must be disabled when connections are not kept by the server for the
+    whole session, eg. behind a pooler in transaction mode.
+  :type  prepare: bool
+  """
+
+  def __init__(e, engine, *, acquire_timeout = None, prepare = True):
+    e._engine = engine
+    e._acquire_timeout = acquire_timeout
+    e.prepare = prepare
+
+    # raw connections with the `_insert_hits` statement prepared
+    e.prepared = weakref.WeakSet()
+
+    e.acquired = 0
+    """number of connections acquired"""
+
+    e.waiting = 0
+    """number of tasks waiting for a connection"""
+
+    e.acquire_time = 0.0
+    """total seconds spent waiting for connections"""
+
+    e.timeouts = 0
+    """number of times waiting for a connection timed out"""
+
+  def acquire(e):
+    """
+    :returns: asynchronous context manager of aiopg.sa.SAConnection
+    """
+    return _Acquire(e)
+
+  def stats(e):
+    """
+    :returns: statistics of the connection pool
+    :rtype: dict
+    """
+    return dict(
+      size         = e._engine.size
+    , in_use       = e._engine.size - e._engine.freesize
+    , minsize      = e._engine.minsize
+    , maxsize      = e._engine.maxsize
+    , waiting      = e.waiting
+    , acquired     = e.acquired
+    , acquire_time = e.acquire_time / e.acquired if e.acquired else 0.0
+    , timeouts     = e.timeouts
+    )
+
+  def __getattr__(e, name):
+    return getattr(e._engine, name)
+
+class _Acquire:
+  def __init__(a, engine):
+    a._e = engine
+    a._conn = None
+
+  async def __aenter__(a):
+    e = a._e
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+
+    e.waiting += 1
+    try:
+      a._conn = await asyncio.wait_for(e._engine.acquire(), e._acquire_timeout)
+    except asyncio.TimeoutError:
+      e.timeouts += 1
+      raise
+    finally:
+      e.waiting -= 1
+
+    e.acquired += 1
+    e.acquire_time += loop.time() - start
+    return a._conn
+
+  async def __aexit__(a, *exc_info):
+    conn, a._conn = a._conn, None
+    await a._e._engine.release(conn)
 
 class DSN(str):
   """
@@ -55,7 +268,16 @@ class DSN(str):
     raise ValueError on invalid input
   """
 
-async def register_hit(engine, page_no, session_id, ip, socket, headers):
+async def register_hit(
+  engine
+, page_no
+, session_id
+, ip
+, socket
+, headers
+, *
+, header_cache = None
+):
   """
   :param engine:
   :type  engine: aiopg.sa.Engine
@@ -72,38 +294,1016 @@ async def register_hit(engine, page_no, session_id, ip, socket, headers):
   :param socket:
   :type  socket: int
 
-  :param headers:
+  :param headers: as returned by `HeaderPolicy`
   :type  headers: dict
 
+  :param header_cache: see `register_hits`
+
   :rtype: None
   """
+  await register_hits(
+    engine
+  , [_hit_row(page_no, session_id, ip, socket, headers)]
+  , header_cache = header_cache
+  )
+
+async def register_hits(engine, rows, batch_size = None, header_cache = None):
+  """
+  Inserts many hits in a single transaction using multi-row INSERTs.
+
+  Their headers are stored in `header_sets` unless they are there
+  already. Without such header sets and with a single INSERT, no
+  transaction is opened.
+
+  :param rows: as returned by `_hit_row`
+  :type  rows: [dict]
+
+  :param batch_size: maximum number of rows per INSERT.
+    All rows are inserted at once by default.
+  :type  batch_size: int
+
+  :param header_cache: header sets known to be stored, so they need not
+    be inserted again
+  :type  header_cache: HeaderSetCache
+
+  :rtype: None
+  """
+  if not rows:
+    return
+
+  batch_size = batch_size or len(rows)
+  rows, new = _intern_headers(rows, header_cache)
+
+  async with engine.acquire() as conn:
+    if not new and len(rows) <= batch_size:
+      # atomic on its own
+      await _insert_hits(engine, conn, rows)
+      return
+
+    async with conn.begin():
+      await _insert_header_sets(conn, new)
+      for i in range(0, len(rows), batch_size):
+        await _insert_hits(engine, conn, rows[i:i + batch_size])
+
+  # only once they are committed
+  if header_cache is not None:
+    header_cache.update(new)
+
+# columns of `_hit_row` after `_intern_headers` and their array types
+_hit_columns = [
+  ('page_no'   , 'integer[]')
+, ('session_id', 'uuid[]')
+, ('ip'        , 'inet[]')
+, ('socket'    , 'integer[]')
+, ('header_set', 'bigint[]')
+]
+
+# INSERT of any number of hits passed as an array per column, so it is
+# compiled once rather than for every batch
+_insert_hits_sql = """
+  INSERT INTO hits ({})
+  SELECT * FROM unnest({})
+""".format(
+  ', '.join(x for x, _ in _hit_columns)
+, ', '.join('%({})s::{}'.format(*x) for x in _hit_columns)
+)
+
+_prepare_hits_sql = """
+  PREPARE aiohex_insert_hits ({}) AS
+  INSERT INTO hits ({})
+  SELECT * FROM unnest({})
+""".format(
+  ', '.join(t for _, t in _hit_columns)
+, ', '.join(x for x, _ in _hit_columns)
+, ', '.join('${}'.format(i) for i in range(1, len(_hit_columns) + 1))
+)
+
+_execute_hits_sql = "EXECUTE aiohex_insert_hits ({})".format(
+  ', '.join('%({})s::{}'.format(*x) for x in _hit_columns)
+)
+
+async def _insert_hits(engine, conn, rows):
+  """
+  Inserts `rows` returned by `_intern_headers` using the statement
+  prepared on `conn` if `Engine.prepare` is enabled.
+  """
+  params = dict(
+    (k, [str(x[k]) if k == 'session_id' else x[k] for x in rows])
+    for k, _ in _hit_columns
+  )
+
+  if not engine.prepare:
+    await conn.execute(_insert_hits_sql, params)
+    return
+
+  raw = conn.connection
+  if raw not in engine.prepared:
+    await conn.execute(_prepare_hits_sql)
+    engine.prepared.add(raw)
+
+  await conn.execute(_execute_hits_sql, params)
+
+def _intern_headers(rows, header_cache):
+  """
+  :returns: copies of `rows` referring to the header sets instead of
+    containing the headers, and the header sets to insert by their
+    fingerprints
+  :rtype: ([dict], {int: dict})
+
+  >>> rows, new = _intern_headers([dict(headers = {'a': '1'})], None)
+  >>> rows[0]['header_set'] == fingerprint({'a': '1'}), list(new.values())
+  (True, [{'a': '1'}])
+  """
+  new = dict()
+  interned = []
+  for x in rows:
+    x = dict(x)
+    headers = x.pop('headers', None)
+    x['header_set'] = fp = fingerprint(headers)
+    interned.append(x)
+
+    if fp is None or fp in new:
+      continue
+
+    if header_cache is None or fp not in header_cache:
+      new[fp] = headers
+
+  return interned, new
+
+async def _insert_header_sets(conn, new):
+  """
+  :param new: header sets by their fingerprints as returned by
+    `_intern_headers`
+  :type  new: {int: dict}
+  """
+  if not new:
+    return
+
+  await conn.execute(
+    pgdia.insert(header_sets)
+      .values([dict(fingerprint = k, headers = v) for k, v in new.items()])
+      .on_conflict_do_nothing()
+  )
+
+def fingerprint(headers):
+  """
+  Hashes the headers into a signed 64 bit integer. Sets of headers with
+  colliding fingerprints share the `header_sets` row of the first one.
+
+  :param headers: as returned by `HeaderPolicy`
+  :type  headers: dict
+
+  :returns: fingerprint or None if there are no headers
+  :rtype: int
+
+  >>> fingerprint({'a': '1', 'b': '2'}) == fingerprint({'b': '2', 'a': '1'})
+  True
+  >>> fingerprint({'a': '1'}) == fingerprint({'a': '2'})
+  False
+  >>> fingerprint(None) is None
+  True
+  """
+  if not headers:
+    return None
+
+  digest = hashlib.sha1(
+    json.dumps(headers, sort_keys = True, separators = (',', ':'))
+      .encode('utf-8')
+  ).digest()
+  return int.from_bytes(digest[:8], 'big', signed = True)
+
+class HeaderSetCache:
+  """
+  Fingerprints of the header sets known to be in `header_sets`.
+  The least recently used ones are forgotten once there are more than
+  `max_entries` of them.
+
+  :param max_entries: None to remember any number of fingerprints
+  :type  max_entries: int
+
+  >>> hc = HeaderSetCache(max_entries = 2)
+  >>> hc.update([1, 2])
+  >>> 1 in hc
+  True
+  >>> hc.update([3])
+  >>> 2 in hc, 1 in hc, 3 in hc
+  (False, True, True)
+  """
+
+  def __init__(hc, *, max_entries = None):
+    hc._max_entries = max_entries
+    hc._fingerprints = collections.OrderedDict()
+
+  def __contains__(hc, fp):
+    if fp not in hc._fingerprints:
+      return False
+
+    hc._fingerprints.move_to_end(fp)
+    return True
+
+  def __len__(hc):
+    return len(hc._fingerprints)
+
+  def update(hc, fps):
+    """
+    :param fps: fingerprints of header sets which were stored
+    :type  fps: [int]
+    """
+    for x in fps:
+      hc._fingerprints[x] = None
+      hc._fingerprints.move_to_end(x)
 
-  q = hits.insert().values(
+    if hc._max_entries is not None:
+      while len(hc._fingerprints) > hc._max_entries:
+        hc._fingerprints.popitem(last = False)
+
+def _hit_row(page_no, session_id, ip, socket, headers):
+  """
+  :returns: `hits` row for the `register_hit` parameters
+  :rtype: dict
+  """
+  return dict(
     page_no    = page_no
   , session_id = session_id
   , ip         = ip
   , socket     = socket
-  , headers    = str(headers)
+  , headers    = headers or None
   )
 
-  async with engine.acquire() as conn:
-    await conn.execute(q)
+class HeaderPolicy:
+  """
+  Selects the request headers stored along with each hit.
+
+  Header names are lower-cased and values of repeated headers joined by
+  a comma.
+
+  :param allow: names of headers to store. All headers if None.
+  :type  allow: [str]
+
+  :param max_length: maximum length of stored values, including the
+    joined values of repeated headers. Longer values are truncated.
+    No limit if None.
+  :type  max_length: int
+
+  >>> hp = HeaderPolicy(allow = ['User-Agent', 'Accept'], max_length = 3)
+  >>> hp([('USER-AGENT', 'curl/7'), ('Cookie', 'x'), ('Accept', '*/*')])
+  {'user-agent': 'cur', 'accept': '*/*'}
+  >>> hp([('Accept', 'a'), ('Accept', 'b')])
+  {'accept': 'a, '}
+  >>> HeaderPolicy()([('Via', 'a'), ('via', 'b')])
+  {'via': 'a, b'}
+  >>> HeaderPolicy(allow = [])([('Via', 'a')]) is None
+  True
+  """
+
+  def __init__(hp, *, allow = None, max_length = None):
+    hp._allow = None if allow is None else set(x.lower() for x in allow)
+    hp._max_length = max_length
+
+  def __call__(hp, headers):
+    """
+    :param headers: header name and value pairs
+    :type  headers: [(str, str)]
+
+    :returns: the headers to store or None if there are none
+    :rtype: {str: str}
+    """
+    if hp._allow is not None and not hp._allow:
+      return None
+
+    r = dict()
+    for name, value in headers:
+      name = name.lower()
+      if hp._allow is not None and name not in hp._allow:
+        continue
+
+      value = value if name not in r else r[name] + ', ' + value
+      if hp._max_length is not None:
+        value = value[:hp._max_length]
+
+      r[name] = value
+
+    return r or None
+
+class Overloaded(RuntimeError):
+  """
+  Raised by `HitAdmission` rejecting a hit.
+  """
+
+class HitAdmission:
+  """
+  Limits the number of hits being recorded at once to `max_in_flight`,
+  so a slow database does not make requests pile up.
+
+  A hit arriving while the limit is reached is handled according to
+  `policy`, one of `policies`:
+
+  `wait`
+    for the hits being recorded
+  `drop`
+    the hit, counting it in `dropped`
+  `sample`
+    waits with probability `sample_rate` and drops the hit otherwise
+  `reject`
+    raises `Overloaded`, counting it in `rejected`
+
+  :param register_hit: records the hit, eg. `HitBuffer.register_hit`
+  :type  register_hit: callable
+
+  :param max_in_flight:
+  :type  max_in_flight: int
+
+  :param policy:
+  :type  policy: str
+
+  :param sample_rate:
+  :type  sample_rate: float
+
+  :param random: returns a random number in [0, 1)
+  :type  random: callable
+
+  >>> async def slow(*args):
+  ...   await asyncio.sleep(0.01)
+  >>> ha = HitAdmission(slow, max_in_flight = 2, policy = 'drop')
+  >>> _ = asyncio.get_event_loop().run_until_complete(asyncio.gather(
+  ...   *[ha.register_hit(1, None, '::1', 1, None) for _ in range(5)]
+  ... ))
+  >>> sorted(ha.stats().items())
+  [('admitted', 2), ('dropped', 3), ('in_flight', 0), ('rejected', 0), ('waiting', 0)]
+  """
+
+  policies = ('wait', 'drop', 'sample', 'reject')
+
+  def __init__(
+    ha
+  , register_hit
+  , *
+  , max_in_flight
+  , policy      = 'wait'
+  , sample_rate = 0.1
+  , random      = random.random
+  ):
+    if policy not in ha.policies:
+      raise ValueError('Invalid overload policy ' + repr(policy))
+
+    ha._register_hit = register_hit
+    ha._semaphore = asyncio.Semaphore(max_in_flight)
+    ha._policy = policy
+    ha._sample_rate = sample_rate
+    ha._random = random
+
+    ha.in_flight = 0
+    """number of hits being recorded"""
+
+    ha.waiting = 0
+    """number of hits waiting to be recorded"""
+
+    ha.admitted = 0
+    ha.dropped = 0
+    ha.rejected = 0
+
+  async def register_hit(ha, *args):
+    """
+    Same as `register_hit` given to the constructor.
+
+    :raises Overloaded: if the hit is rejected
+    """
+    if ha._semaphore.locked() and not ha._admit():
+      return
+
+    ha.waiting += 1
+    try:
+      await ha._semaphore.acquire()
+    finally:
+      ha.waiting -= 1
+
+    ha.in_flight += 1
+    ha.admitted += 1
+    try:
+      await ha._register_hit(*args)
+    finally:
+      ha.in_flight -= 1
+      ha._semaphore.release()
+
+  def stats(ha):
+    """
+    :rtype: dict
+    """
+    return dict(
+      in_flight = ha.in_flight
+    , waiting   = ha.waiting
+    , admitted  = ha.admitted
+    , dropped   = ha.dropped
+    , rejected  = ha.rejected
+    )
+
+  def _admit(ha):
+    """
+    :returns: True if the hit is to wait for the limit
+    :rtype: bool
+    """
+    if ha._policy == 'reject':
+      ha.rejected += 1
+      raise Overloaded("Too many hits being recorded")
+
+    if ha._policy == 'wait' or (
+      ha._policy == 'sample' and ha._random() < ha._sample_rate
+    ):
+      return True
+
+    ha.dropped += 1
+    return False
+
+class HitBuffer:
+  """
+  Write-behind buffer for hits.
+
+  `register_hit` only enqueues the hit and a background task inserts
+  the queued hits in batches of up to `flush_size` rows, at latest
+  `flush_interval` seconds after the first hit of the batch arrived.
+
+  Once `max_queue` hits are waiting, `register_hit` blocks until the
+  background task catches up. Unless there is a `spool`, in which case
+  the hit is appended to the spool instead. So are the batches which
+  fail to be inserted.
+
+  Once anything was spooled, all hits go to the spool until it is
+  replayed, to keep the hits of each session in order. Hits arriving
+  while a batch is being inserted are held back until the insert either
+  succeeds or fails and the batch is spooled ahead of them. The spool is
+  written in an executor and replayed every `replay_interval` seconds
+  while the queue is empty.
+
+  :param engine:
+  :type  engine: aiopg.sa.Engine
+
+  :param flush_size: maximum number of rows per INSERT
+  :type  flush_size: int
+
+  :param flush_interval: maximum age of a batch in seconds
+  :type  flush_interval: float
+
+  :param max_queue: maximum number of hits waiting to be flushed
+  :type  max_queue: int
+
+  :param spool:
+  :type  spool: spool.Spool
+
+  :param replay_interval: seconds between spool replay attempts
+  :type  replay_interval: float
+
+  :param header_cache: see `register_hits`
+  :type  header_cache: HeaderSetCache
+  """
+
+  def __init__(
+    b
+  , engine
+  , *
+  , flush_size      = 500
+  , flush_interval  = 1.0
+  , max_queue       = 10000
+  , spool           = None
+  , replay_interval = 5.0
+  , header_cache    = None
+  ):
+    b._engine = engine
+    b._header_cache = header_cache
+    b._flush_size = flush_size
+    b._flush_interval = flush_interval
+    b._loop = asyncio.get_event_loop()
+    b._queue = asyncio.Queue(max_queue)
+    b._task = None
+
+    b._spool = spool
+    b._spooling = spool is not None and bool(spool.segments())
+    b._spool_lock = asyncio.Lock()
+    b._spool_task = None
+    b._unspooled = []
+    b._in_flight = False
+    b._held = []
+    b._replay_interval = replay_interval
+    b._replay_task = None
+
+  # queue item which tells the background task to stop
+  _stop = object()
+
+  async def register_hit(b, page_no, session_id, ip, socket, headers):
+    """
+    Same as the module level `register_hit` except it does not wait for
+    the database.
+    """
+    row = _hit_row(page_no, session_id, ip, socket, headers)
+
+    if b._spool is not None and (b._spooling or b._queue.full()):
+      b._spool_rows(b._drain() + [row])
+    else:
+      await b._queue.put(row)
+
+  @property
+  def depth(b):
+    """
+    :returns: number of hits waiting to be flushed
+    :rtype: int
+    """
+    return b._queue.qsize()
+
+  def start(b):
+    """
+    Starts the background flushing task.
+    """
+    assert b._task is None, "Already started"
+    b._task = asyncio.ensure_future(b._run())
+
+    if b._spool is not None:
+      b._replay_task = asyncio.ensure_future(b._replay())
+
+  async def close(b):
+    """
+    Flushes whatever is left in the queue and stops the background task.
+    """
+    if b._task is None:
+      return
+
+    await b._queue.put(b._stop)
+    await b._task
+    b._task = None
+
+    if b._replay_task is not None:
+      b._replay_task.cancel()
+      try:
+        await b._replay_task
+      except asyncio.CancelledError:
+        pass
+      b._replay_task = None
+
+    if b._spool is not None:
+      if b._spool_task is not None:
+        await b._spool_task
+
+      async with b._spool_lock:
+        await b._loop.run_in_executor(None, b._spool.close)
+
+  async def _run(b):
+    stopping = False
+    while not stopping:
+      rows = [await b._queue.get()]
+      b._in_flight = True
+      deadline = b._loop.time() + b._flush_interval
+
+      while len(rows) < b._flush_size and rows[-1] is not b._stop:
+        if not b._queue.empty():
+          rows.append(b._queue.get_nowait())
+          continue
+
+        timeout = deadline - b._loop.time()
+        if timeout <= 0:
+          break
+
+        try:
+          rows.append(await asyncio.wait_for(b._queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      if rows[-1] is b._stop:
+        rows.pop()
+        stopping = True
+
+      await b._flush(rows)
+
+  async def _flush(b, rows):
+    spooled = []
+    if b._spooling:
+      spooled = rows
+    else:
+      try:
+        await register_hits(b._engine, rows, header_cache = b._header_cache)
+      except Exception:
+        if b._spool is None:
+          log.exception("Failed to insert %d buffered hits", len(rows))
+        else:
+          log.warning("Spooling %d hits", len(rows), exc_info = True)
+          spooled = rows
+
+    # the batch precedes the hits held back while it was inserted
+    b._in_flight = False
+    held, b._held = b._held, []
+    if spooled or held:
+      b._spool_rows(spooled + held)
+
+  def _drain(b):
+    """
+    :returns: hits waiting in the queue, removing them from it
+    :rtype: [dict]
+    """
+    rows = []
+    while not b._queue.empty():
+      rows.append(b._queue.get_nowait())
+
+    if rows and rows[-1] is b._stop:
+      b._queue.put_nowait(rows.pop())
+
+    return rows
+
+  def _spool_rows(b, rows):
+    """
+    Appends `rows` to the spool after any rows spooled before, without
+    waiting for the disk.
+    """
+    b._spooling = True
+    if b._in_flight:
+      b._held.extend(rows)
+      return
+
+    b._unspooled.extend(rows)
+    if b._spool_task is None or b._spool_task.done():
+      b._spool_task = asyncio.ensure_future(b._write_spool())
+
+  async def _write_spool(b):
+    while b._unspooled:
+      async with b._spool_lock:
+        rows, b._unspooled = b._unspooled, []
+        try:
+          await b._loop.run_in_executor(None, b._spool.extend, rows)
+        except Exception:
+          log.exception("Failed to spool %d hits", len(rows))
 
-async def get_transitions(engine, exit_state = None):
+  async def _replay(b):
+    while True:
+      await asyncio.sleep(b._replay_interval)
+      if not b._spooling or b._in_flight or not b._queue.empty():
+        continue
+
+      try:
+        await b._replay_spool()
+      except Exception:
+        log.warning("Failed to replay spooled hits", exc_info = True)
+
+  async def _replay_spool(b):
+    run = b._loop.run_in_executor
+    while True:
+      async with b._spool_lock:
+        await run(None, b._spool.rotate)
+        segments = await run(None, b._spool.segments)
+        if not segments and not b._unspooled:
+          b._spooling = False
+          return
+
+      for x in segments:
+        await register_hits(
+          b._engine
+        , await run(None, b._spool.read, x)
+        , b._flush_size
+        , b._header_cache
+        )
+        await run(None, b._spool.remove, x)
+
+async def get_transitions(engine, exit_state = None, chunk_size = 10000):
   """
   :param exit_state: value to represent exit_state with.
   :type  exit_state: object
 
+  :param chunk_size: see `stream_sessions`
+
   :returns: dict(session_id = transition_graph)
   :rtype: dict(UUID = markov.Graph]
   """
+  tgs = dict()
+
+  def f(sid, tg):
+    tgs[sid] = tg
+
+  await stream_transitions(engine, f, chunk_size)
+  return tgs
+
+async def fold_transitions(engine, exit_state = None, chunk_size = 10000):
+  """
+  Same as `get_aggregated_transitions` except the transitions are
+  counted while streaming the hits.
+
+  :param chunk_size: see `stream_chunks`
+
+  :rtype: markov.Counts
+  """
+  counts = markov.Counts()
+
+  def f(xs):
+    nonlocal counts
+    counts += markov.Counts.from_sessions(*_stream_columns(xs))
+
+  await stream_chunks(engine, f, chunk_size)
+  return counts
+
+async def count_paths(engine, order, max_paths = None, chunk_size = 10000):
+  """
+  Counts the paths of up to `order` pages while streaming the hits.
+
+  :param max_paths: see `markov.Paths`
+  :param chunk_size: see `stream_chunks`
+
+  :rtype: markov.Paths
+  """
+  paths = markov.Paths(order, max_paths)
+
+  def f(xs):
+    paths.add_sessions(*_stream_columns(xs))
+
+  await stream_chunks(engine, f, chunk_size)
+  return paths
+
+async def stream_transitions(engine, f, chunk_size = 10000):
+  """
+  Calls `f(session_id, transition_graph)` for every session.
+
+  :param f:
+  :type  f: callable(uuid.UUID, markov.Graph)
+
+  :param chunk_size: see `stream_chunks`
+  """
+  def g(xs):
+    for x in _hits_to_graphs(xs, None).items():
+      f(*x)
+
+  await stream_chunks(engine, g, chunk_size)
+
+async def stream_sessions(engine, f, chunk_size = 10000):
+  """
+  Calls `f(session_id, pages)` for every session, with the pages in
+  chronological order.
+
+  :param f:
+  :type  f: callable(uuid.UUID, [int])
+
+  :param chunk_size: see `stream_chunks`
+  """
+  def g(xs):
+    for sid, pages in _group_sessions(xs):
+      f(sid, list(pages))
+
+  await stream_chunks(engine, g, chunk_size)
+
+async def update_transition_cache(engine, tc, chunk_size = 10000):
+  """
+  Merges the hits inserted since the last update into the cache.
+
+  .. warning::
+
+    Hits are assumed to become visible in the order of their ids. A hit
+    whose transaction commits after a hit with greater id was already
+    merged is never merged.
+
+  :param tc:
+  :type  tc: cache.TransitionCache
+
+  :param chunk_size: see `stream_chunks`
+  """
+  def f(xs):
+    tc.update(
+      *_stream_columns(xs)
+    , ids   = [x[2] for x in xs]
+    , times = [x[4].timestamp() for x in xs]
+    , keys  = [x[1] for x in xs]
+    )
+
+  await stream_chunks(
+    engine, f, chunk_size, since = tc.watermark, columns = [hits.c.created]
+  )
+
+async def stream_chunks(
+  engine
+, f
+, chunk_size = 10000
+, since      = None
+, columns    = ()
+):
+  """
+  Calls `f(hits)` for consecutive chunks of hits, where
+  `hits` is `[(page_no, session_id, id, session_no, *columns)]` sorted by
+  session_id and then in chronological order, each chunk holding only
+  whole sessions. The `session_no` numbers the sessions in order, see
+  `_stream_columns`.
+
+  The hits are read through a server-side cursor `chunk_size` rows at a
+  time so only the current chunk and the session spanning it is held in
+  memory.
+
+  :param f:
+  :type  f: callable([(int, uuid.UUID, int, int)])
+
+  :param chunk_size: number of rows fetched at once
+  :type  chunk_size: int
+
+  :param since: read only hits with greater id
+  :type  since: int
+
+  :param columns: other columns of `hits` to read
+  :type  columns: [sa.Column]
+  """
+  session_no = sql.func.dense_rank().over(order_by = hits.c.session_id)
+  q = sql.Select(
+    [hits.c.page_no, hits.c.session_id, hits.c.id, session_no]
+    + list(columns)
+  ).order_by(hits.c.session_id, hits.c.id)
+
+  if since is not None:
+    q = q.where(hits.c.id > since)
+
+  async with engine.acquire() as conn:
+    async with conn.begin():
+      await _declare_cursor(conn, "aiohex_hits", q)
+
+      # chunks of the last session seen, concatenated only once it is
+      # complete
+      parts = []
+      while True:
+        xs = await _fetch(conn, "aiohex_hits", chunk_size)
+        if not xs:
+          break
+
+        i = _last_session_start(xs)
+        if parts and not i and xs[0][1] == parts[0][0][1]:
+          parts.append(xs)
+          continue
+
+        if parts or i:
+          f(list(itertools.chain.from_iterable(parts)) + xs[:i])
+
+        parts = [xs[i:]]
+
+  if parts:
+    f(list(itertools.chain.from_iterable(parts)))
+
+async def _declare_cursor(conn, name, q):
+  """
+  Declares server-side cursor `name` for the query `q`.
+  Must be called inside a transaction.
+  """
+  q = q.compile(
+    dialect = pgdia.dialect()
+  , compile_kwargs = dict(literal_binds = True)
+  )
+  await conn.execute("DECLARE {} NO SCROLL CURSOR FOR {}".format(name, q))
+
+async def _fetch(conn, name, n):
+  """
+  :returns: up to `n` next rows of the cursor `name`
+  :rtype: list
+  """
+  xs = await conn.execute("FETCH FORWARD {:d} FROM {}".format(n, name))
+  return await xs.fetchall()
+
+def _last_session_start(xs):
+  """
+  :param xs: [(page_id, session_id)]
+  :returns: index of the first row of the last session in `xs`
+
+  >>> _last_session_start([(1, 1), (3, 1), (1, 2), (2, 2)])
+  2
+  >>> _last_session_start([(1, 1)])
+  0
+  """
+  i = len(xs) - 1
+  while i > 0 and xs[i - 1][1] == xs[-1][1]:
+    i -= 1
+
+  return i
+
+async def get_session_transitions(engine, session_id, exit_state = None):
+  """
+  :param session_id:
+  :type  session_id: uuid.UUID
+
+  :returns: transition graph of the session or None if it has no hits
+  :rtype: markov.Graph
+  """
   q = sql.Select([hits.c.page_no, hits.c.session_id]) \
-    .order_by(hits.c.session_id, hits.c.id)
+    .where(hits.c.session_id == session_id) \
+    .order_by(hits.c.id)
+
+  async with engine.acquire() as conn:
+    xs = await (await conn.execute(q)).fetchall()
+
+  return _hits_to_graphs(xs, exit_state).get(session_id)
+
+async def get_aggregated_transitions(engine, exit_state = None):
+  """
+  Same as merging all the graphs returned by `get_transitions` except
+  the transitions are counted by the database.
+
+  :param exit_state: value to represent exit_state with.
+  :type  exit_state: object
+
+  :rtype: markov.Counts
+  """
+  if exit_state is None:
+    exit_state = markov.Graph.exit_state
+
+  next_page = sql.func.lead(hits.c.page_no).over(
+    partition_by = hits.c.session_id
+  , order_by     = hits.c.id
+  )
+
+  ts = sql.Select([
+    hits.c.page_no.label("u")
+  , sql.func.coalesce(next_page, exit_state).label("v")
+  ]).alias("ts")
+
+  q = sql.Select([ts.c.u, ts.c.v, sql.functions.count().label("n")]) \
+    .group_by(ts.c.u, ts.c.v) \
+    .order_by(ts.c.u, ts.c.v)
+
+  async with engine.acquire() as conn:
+    xs = await (await conn.execute(q)).fetchall()
+
+  return markov.Counts.from_weighted_edges(xs)
+
+async def get_transition_counts(engine):
+  """
+  Reads the transitions counted by the `count_transition` trigger.
+  Exits of sessions which were not closed by `close_sessions` yet are
+  not included.
+
+  :rtype: markov.Counts
+  """
+  q = sql.Select([
+    transition_counts.c.from_page
+  , transition_counts.c.to_page
+  , transition_counts.c.n
+  ])
+
+  async with engine.acquire() as conn:
+    xs = await (await conn.execute(q)).fetchall()
+
+  return markov.Counts.from_weighted_edges(xs)
+
+async def close_sessions(engine, idle):
+  """
+  Counts the exit transition of every session without a hit in the last
+  `idle` seconds.
+
+  :param idle:
+  :type  idle: float
+
+  :returns: number of closed sessions
+  :rtype: int
+  """
+  q = sa.text("""
+    WITH closed AS (
+      DELETE FROM session_heads
+      WHERE last_seen < now() - :idle * interval '1 second'
+      RETURNING page_no
+    )
+    , counted AS (
+      INSERT INTO transition_counts (from_page, to_page, n)
+      SELECT page_no, :exit_state, count(*) FROM closed GROUP BY page_no
+      ON CONFLICT (from_page, to_page)
+      DO UPDATE SET n = transition_counts.n + EXCLUDED.n
+    )
+    SELECT count(*) FROM closed
+  """)
 
   async with engine.acquire() as conn:
-    xs = await conn.execute(q)
+    return await conn.scalar(q.bindparams(
+      idle       = idle
+    , exit_state = markov.Graph.exit_state
+    ))
+
+async def rebuild_transition_counts(engine):
+  """
+  Recomputes `transition_counts` and `session_heads` from `hits`.
+
+  All sessions are considered open afterwards, so their exits get
+  counted by `close_sessions` once they are idle.
+  """
+  next_page = sql.func.lead(hits.c.page_no).over(
+    partition_by = hits.c.session_id
+  , order_by     = hits.c.id
+  )
+
+  ts = sql.Select([
+    hits.c.page_no.label("u")
+  , next_page.label("v")
+  ]).alias("ts")
 
-  return _hits_to_graphs(xs, exit_state)
+  counts = sql.Select([ts.c.u, ts.c.v, sql.functions.count()]) \
+    .where(ts.c.v.isnot(None)) \
+    .group_by(ts.c.u, ts.c.v)
+
+  heads = sql.Select([hits.c.session_id, hits.c.page_no]) \
+    .distinct(hits.c.session_id) \
+    .order_by(hits.c.session_id, hits.c.id.desc())
+
+  async with engine.acquire() as conn:
+    async with conn.begin():
+      # keep the trigger from counting hits we would miss
+      await conn.execute("LOCK TABLE hits IN SHARE MODE")
+      await conn.execute("TRUNCATE transition_counts, session_heads")
+      await conn.execute(transition_counts.insert().from_select(
+        ['from_page', 'to_page', 'n'], counts
+      ))
+      await conn.execute(session_heads.insert().from_select(
+        ['session_id', 'page_no'], heads
+      ))
 
 async def get_sessions(engine):
   """
@@ -143,61 +1343,93 @@ def _hits_to_graphs(xs, exit_state):
   >>> _hits_to_graphs([], 0)
   {}
   """
-  # group by session id
-  xs = [[y for y in x[1]] for x in itertools.groupby(xs, lambda x: x[1])]
+  if not xs:
+    return dict()
 
-  # extract session ids
-  xs = ((x[0][1], (y[0] for y in x)) for x in xs)
+  pages, codes = _columns(xs)
+  session_ids = [xs[i][1] for i in np.flatnonzero(np.r_[True, np.diff(codes)])]
+  codes, us, vs, ns = markov.session_transitions(pages, codes)
 
-  # convert to transition tuples
-  xs = ((sid, _insert_peeks(ts, markov.Graph.exit_state))
-    for sid, ts in xs
-  )
+  # split the transitions by session
+  starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+  ends = np.r_[starts[1:], len(codes)]
 
-  # convert to graph
-  xs = ((sid, markov.Graph.from_edges(ts))
-    for sid, ts in xs
+  return dict(
+    (session_ids[codes[i]], markov.Graph.from_weighted_edges(zip(
+      us[i:j].tolist()
+    , vs[i:j].tolist()
+    , ns[i:j].tolist()
+    )))
+    for i, j in zip(starts.tolist(), ends.tolist())
   )
 
-  return dict(xs)
+def _columns(xs):
+  """
+  :param xs: [(page_id, session_id)] grouped by session_id
+  :returns: page_ids and codes numbering the sessions from 0, which are
+    much cheaper to compare than the session ids
+  :rtype: (np.array, np.array)
 
-def _insert_peeks(xs, end_peek = None):
+  >>> a, b = uuid.UUID(int = 1), uuid.UUID(int = 2)
+  >>> pages, codes = _columns([(1, a), (3, a), (1, b)])
+  >>> pages.tolist(), codes.tolist()
+  ([1, 3, 1], [0, 0, 1])
+  >>> _columns([(1, 'a'), (2, 'b')])[1].tolist()
+  [0, 1]
   """
-  Converts each element `x` of `xs` into
-  a tuple `(x, next_element_of_xs_aka_peek)`
+  pages = np.fromiter((x[0] for x in xs), dtype = np.int64, count = len(xs))
 
-  More formally, converts xs into ys where::
+  if xs and isinstance(xs[0][1], uuid.UUID):
+    # pairs of 64 bit integers rather than UUID objects
+    sids = np.frombuffer(
+      b''.join([x[1].bytes for x in xs]), dtype = np.uint64
+    ).reshape(-1, 2)
+    changes = (sids[1:] != sids[:-1]).any(axis = 1)
+  else:
+    sids = np.empty(len(xs), dtype = object)
+    sids[:] = [x[1] for x in xs]
+    changes = sids[1:] != sids[:-1]
 
-    ys[N] is (x[N], x[N+1])     for N+1 < len(xs) and
-    ys[N] is (x[N], end_peek)   for N+1 == len(xs)
+  codes = np.zeros(len(xs), dtype = np.int64)
+  np.cumsum(changes, out = codes[1:])
 
-  :param xs:
-  :type  xs: [object]
+  return pages, codes
 
-  :param end_peek: item to use instead of peek for last element
-  :type  end_peek: object
+def _stream_columns(xs):
+  """
+  Same as `_columns` for the hits from `stream_chunks`, taking the
+  session codes numbered by the database, so no session ids need to be
+  compared.
 
-  >>> list(_insert_peeks((x for x in range(1,4))))
-  [(1, 2), (2, 3), (3, None)]
+  >>> pages, codes = _stream_columns([(1, 'a', 1, 5), (2, 'a', 2, 5)])
+  >>> pages.tolist(), codes.tolist()
+  ([1, 2], [5, 5])
   """
-  # TODO: There is more_itertools.peekable but I couldn't get it to
-  #       work as expected
-  if xs == []:
-    return []
+  n = len(xs)
+  return (
+    np.fromiter(map(operator.itemgetter(0), xs), dtype = np.int64, count = n)
+  , np.fromiter(map(operator.itemgetter(3), xs), dtype = np.int64, count = n)
+  )
+
+def _group_sessions(xs):
+  """
+  :param xs: [(page_id, session_id)]
+    must be sorted by session_id and then in chronological order
 
-  r = next(xs)
-  while True:
-    peek = next(xs, end_peek)
-    yield (r, peek)
-    if peek is end_peek:
-      break
+  :returns: (session_id, pages) for each session
+  :rtype: iter((uuid.UUID, iter(int)))
 
-    r = peek
+  >>> xs = _group_sessions([(1, 1), (3, 1), (1, 2)])
+  >>> [(sid, list(pages)) for sid, pages in xs]
+  [(1, [1, 3]), (2, [1])]
+  """
+  for sid, ys in itertools.groupby(xs, lambda x: x[1]):
+    yield (sid, (y[0] for y in ys))
 
-def _create_tables(*args, **kwargs):
+def create_tables(dsn, *, track_transitions = False, partition_by = None):
   """
-  Connects to postgresql instance identified by `dsn` and creates all
-  tables if missing.
+  Connects to postgresql instance identified by `dsn`, creates all
+  tables if missing and migrates them to the current `_migrations`.
 
   The SQLAlchemy can not execute queries via the async API, so this
   function creates the SQLAlchemy Engine to run the CREATE TABLES and
@@ -205,8 +1437,292 @@ def _create_tables(*args, **kwargs):
 
   :param dsn:
   :type  dsn: DSN
+
+  :param track_transitions: install the `count_transition` trigger,
+    drop it otherwise
+  :type  track_transitions: bool
+
+  :param partition_by: column to range partition `hits` by, one of
+    `partition_columns`. Applies only when the table is created.
+    See `create_partitions`.
+  :type  partition_by: str
   """
 
-  e = sa.create_engine(*args, **kwargs)
-  metadata.create_all(e)
+  e = sa.create_engine(dsn)
+
+  with e.begin() as conn:
+    # serialize concurrently starting processes
+    conn.execute(sql.select([sql.func.pg_advisory_xact_lock(_schema_lock)]))
+
+    if not e.dialect.has_table(conn, hits.name):
+      _hits_table(sa.MetaData(), partition_by).create(conn)
+      if partition_by:
+        conn.execute("CREATE TABLE hits_default PARTITION OF hits DEFAULT")
+
+    elif partition_by and not _is_partitioned(conn):
+      log.warning(
+        "Table hits already exists without partitioning, ignoring"
+        " partition_by = %s", partition_by
+      )
+
+    metadata.create_all(conn)
+
+    version = conn.scalar(sql.select([schema_version.c.version]))
+    if version is None:
+      version = 0
+      conn.execute(schema_version.insert().values(version = version))
+
+    for x in _migrations[version:]:
+      conn.execute(x)
+
+    conn.execute(schema_version.update().values(version = len(_migrations)))
+
+    conn.execute("DROP TRIGGER IF EXISTS count_transition ON hits")
+    if track_transitions:
+      conn.execute(_count_transition)
+
   e.dispose()
+
+def _is_partitioned(conn):
+  """
+  :returns: True if `hits` is partitioned
+  :rtype: bool
+  """
+  return conn.scalar(
+    "SELECT relkind = 'p' FROM pg_class WHERE oid = 'hits'::regclass"
+  )
+
+# arbitrary key of the advisory lock taken while changing the schema
+_schema_lock = 0x616965786873
+
+# Schema changes applied to databases with `schema_version` lower than
+# their (1 based) index. Must be no-ops on a freshly created schema.
+_migrations = [
+  # 1: timestamp of hits, index for reading the hits session by session
+  # without touching the table
+  """
+  ALTER TABLE hits
+    ADD COLUMN IF NOT EXISTS created timestamptz NOT NULL DEFAULT now();
+
+  DROP INDEX IF EXISTS hits_session_id_id_idx;
+
+  CREATE INDEX IF NOT EXISTS hits_session_id_id_page_no_idx
+    ON hits (session_id, id) INCLUDE (page_no);
+  """
+  # 2: headers as JSON selected by `HeaderPolicy`, the former text
+  # representation of the headers is kept in headers_text
+, """
+  DO $$
+  BEGIN
+    IF (
+      SELECT data_type
+        FROM information_schema.columns
+       WHERE table_schema = current_schema()
+         AND table_name = 'hits'
+         AND column_name = 'headers'
+    ) = 'text' THEN
+      ALTER TABLE hits RENAME COLUMN headers TO headers_text;
+      ALTER TABLE hits ALTER COLUMN headers_text DROP NOT NULL;
+      ALTER TABLE hits ADD COLUMN headers jsonb;
+    END IF;
+  END
+  $$;
+  """
+  # 3: headers stored once per distinct set in header_sets
+, """
+  ALTER TABLE hits ADD COLUMN IF NOT EXISTS header_set bigint;
+  """
+]
+
+async def create_partitions(engine, partition_by, partition_size, ahead = 1):
+  """
+  Creates the partition of `hits` for the current range of the
+  partitioning column and `ahead` following ranges, unless they exist.
+
+  Hits of the range which were already inserted into `hits_default` are
+  moved to the new partition before it is attached, so they are not
+  counted again by the `count_transition` trigger.
+
+  :param partition_by: one of `partition_columns`
+  :type  partition_by: str
+
+  :param partition_size: number of ids per partition when partitioned by
+    id. Partitions by `created` span a calendar month.
+  :type  partition_size: int
+
+  :returns: names of the partitions
+  :rtype: [str]
+  """
+  async with engine.acquire() as conn:
+    if partition_by == 'id':
+      current = await conn.scalar(sql.select([sql.func.max(hits.c.id)]))
+      ranges = _id_ranges(current or 0, partition_size, ahead)
+    else:
+      current = await conn.scalar(sql.select([sql.func.now()]))
+      ranges = _month_ranges(current.year, current.month, ahead)
+
+    async with conn.begin():
+      for name, lo, hi in ranges:
+        await _create_partition(conn, partition_by, name, lo, hi)
+
+  return [x[0] for x in ranges]
+
+async def _create_partition(conn, partition_by, name, lo, hi):
+  """
+  Creates partition `name` of `hits` for `lo <= partition_by < hi`
+  unless it exists, moving its rows out of `hits_default`.
+  """
+  if await conn.scalar("SELECT to_regclass('{}') IS NOT NULL".format(name)):
+    return
+
+  bounds = "FOR VALUES FROM ('{}') TO ('{}')".format(lo, hi)
+  in_range = "{0} >= '{1}' AND {0} < '{2}'".format(partition_by, lo, hi)
+
+  default = await conn.scalar("SELECT to_regclass('hits_default') IS NOT NULL")
+  if not default or not await conn.scalar(
+    "SELECT EXISTS (SELECT 1 FROM hits_default WHERE {})".format(in_range)
+  ):
+    await conn.execute(
+      "CREATE TABLE {} PARTITION OF hits {}".format(name, bounds)
+    )
+    return
+
+  columns = ", ".join(
+    '"{}"'.format(x[0]) for x in await (await conn.execute("""
+      SELECT attname FROM pg_attribute
+      WHERE attrelid = 'hits'::regclass AND attnum > 0 AND NOT attisdropped
+      ORDER BY attnum
+    """)).fetchall()
+  )
+
+  # the default partition may not hold rows of a range being attached.
+  # The rows are moved into a plain table, which has no copy of the
+  # triggers of `hits` to fire, and attaching it fires none.
+  await conn.execute("CREATE TABLE {} (LIKE hits INCLUDING ALL)".format(name))
+  await conn.execute("""
+    WITH moved AS (
+      DELETE FROM hits_default WHERE {1} RETURNING {0}
+    )
+    INSERT INTO {2} ({0}) SELECT {0} FROM moved
+  """.format(columns, in_range, name))
+  await conn.execute(
+    "ALTER TABLE hits ATTACH PARTITION {} {}".format(name, bounds)
+  )
+
+async def drop_partitions(engine, before):
+  """
+  Drops partitions of `hits` created by `create_partitions` which hold
+  only ids or months lower than `before`.
+
+  :param before: id or month in the `YYYYMM` form
+  :type  before: int
+
+  :returns: names of the dropped partitions
+  :rtype: [str]
+  """
+  q = """
+    SELECT c.relname
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'hits'::regclass
+  """
+  async with engine.acquire() as conn:
+    names = [x[0] for x in await (await conn.execute(q)).fetchall()]
+    names = [x for x in names if _partition_end(x) <= before]
+
+    for x in names:
+      await conn.execute("DROP TABLE {}".format(x))
+
+  return names
+
+def _id_ranges(current, size, ahead):
+  """
+  :returns: `(name, lo, hi)` of partitions for the ids
+
+  >>> _id_ranges(15, 10, 1)
+  [('hits_p10_20', 10, 20), ('hits_p20_30', 20, 30)]
+  """
+  lo = current // size * size
+  return [
+    ('hits_p{}_{}'.format(x, x + size), x, x + size)
+    for x in range(lo, lo + (ahead + 1) * size, size)
+  ]
+
+def _month_ranges(year, month, ahead):
+  """
+  :returns: `(name, lo, hi)` of partitions for the months
+
+  >>> _month_ranges(2016, 12, 1)[1]
+  ('hits_p201701_201702', '2017-01-01 00:00+00', '2017-02-01 00:00+00')
+  """
+  def shift(i):
+    y, m = divmod(year * 12 + month - 1 + i, 12)
+    return y, m + 1
+
+  xs = []
+  for i in range(ahead + 1):
+    lo, hi = shift(i), shift(i + 1)
+    xs.append((
+      'hits_p{:04d}{:02d}_{:04d}{:02d}'.format(*(lo + hi))
+    , '{:04d}-{:02d}-01 00:00+00'.format(*lo)
+    , '{:04d}-{:02d}-01 00:00+00'.format(*hi)
+    ))
+
+  return xs
+
+def _partition_end(name):
+  """
+  :returns: upper bound encoded in the name of partitions created by
+    `create_partitions`, infinity for other partitions
+
+  >>> _partition_end('hits_p10_20')
+  20
+  >>> _partition_end('hits_default')
+  inf
+  """
+  m = re.match(r'^hits_p\d+_(\d+)$', name)
+  return int(m.group(1)) if m else float('inf')
+
+# Counts the transition from the previous page of the session to the
+# inserted one, so `transition_counts` is kept up to date without
+# reading `hits`.
+_count_transition = """
+CREATE OR REPLACE FUNCTION count_transition() RETURNS trigger AS $$
+DECLARE
+  prev integer;
+BEGIN
+  LOOP
+    SELECT page_no INTO prev
+    FROM session_heads
+    WHERE session_id = NEW.session_id
+    FOR UPDATE;
+
+    EXIT WHEN FOUND;
+
+    INSERT INTO session_heads (session_id, page_no)
+    VALUES (NEW.session_id, NEW.page_no)
+    ON CONFLICT (session_id) DO NOTHING;
+
+    IF FOUND THEN
+      RETURN NULL;
+    END IF;
+
+    -- a concurrent hit of the session inserted the head first, so lock
+    -- it and count the transition from its page
+  END LOOP;
+
+  UPDATE session_heads
+  SET page_no = NEW.page_no, last_seen = now()
+  WHERE session_id = NEW.session_id;
+
+  INSERT INTO transition_counts (from_page, to_page, n)
+  VALUES (prev, NEW.page_no, 1)
+  ON CONFLICT (from_page, to_page)
+  DO UPDATE SET n = transition_counts.n + 1;
+
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER count_transition AFTER INSERT ON hits
+FOR EACH ROW EXECUTE PROCEDURE count_transition();
+"""
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+Page bodies computed once along with their ETags and compressed
+variants, so serving a page is a lookup.
+"""
+
+import collections
+import hashlib
+import zlib
+
+Page = collections.namedtuple('Page', ['etag', 'variants'])
+"""
+:param etag: strong ETag of the uncompressed body
+:type  etag: str
+
+:param variants: content coding (`identity`, `gzip` or `deflate`):
+  (body, ETag of the body)
+:type  variants: {str: (bytes, str)}
+"""
+
+encodings = ('gzip', 'deflate')
+
+def _gzip(body):
+  # unlike gzip.compress, leaves the mtime at 0, so the body and its
+  # ETag do not change between processes
+  c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return c.compress(body) + c.flush()
+
+_compressors = dict(
+  gzip    = _gzip
+, deflate = lambda body: zlib.compress(body, 9)
+)
+
+def _etag(body):
+  return '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+
+def _variant_etag(etag, coding):
+  """
+  :returns: ETag of the `coding` representation of the body with `etag`.
+    A strong ETag must differ for each representation.
+  """
+  return etag if coding == 'identity' else etag[:-1] + '-' + coding + '"'
+
+def _body_etag(etag):
+  """
+  :returns: ETag of the uncompressed body of the representation with
+    `etag`
+
+  >>> _body_etag('"ab-gzip"'), _body_etag('"ab"')
+  ('"ab"', '"ab"')
+  """
+  return etag.split('-')[0] + '"' if '-' in etag else etag
+
+def create_page(body, encodings = encodings):
+  """
+  Compressed variants are kept only if they are smaller than `body`.
+
+  :param body:
+  :type  body: bytes
+
+  :param encodings: content codings to precompute
+  :type  encodings: [str]
+
+  :rtype: Page
+
+  >>> p = create_page(b'x' * 100)
+  >>> sorted(p.variants)
+  ['deflate', 'gzip', 'identity']
+  >>> p.variants['identity'] == (b'x' * 100, p.etag)
+  True
+  >>> sorted(create_page(b'x').variants)
+  ['identity']
+  """
+  etag = _etag(body)
+  variants = dict(identity = (body, etag))
+
+  for x in encodings:
+    compressed = _compressors[x](body)
+    if len(compressed) < len(body):
+      variants[x] = (compressed, _variant_etag(etag, x))
+
+  return Page(etag, variants)
+
+def accepted_encodings(header):
+  """
+  :param header: value of the Accept-Encoding header
+  :type  header: str
+
+  :returns: content codings acceptable to the client
+  :rtype: {str}
+
+  >>> sorted(accepted_encodings('gzip, deflate;q=0, br'))
+  ['br', 'gzip']
+  """
+  r = set()
+  for x in header.split(','):
+    coding, _, params = x.partition(';')
+    params = params.replace(' ', '')
+    if params in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+      continue
+
+    r.add(coding.strip().lower())
+
+  return r
+
+def matches(header, etags):
+  """
+  :param header: value of the If-None-Match header
+  :type  header: str
+
+  :returns: True if the header matches any of `etags`
+  :rtype: bool
+
+  >>> matches('W/"a", "b"', ['"a"'])
+  True
+  >>> matches('*', [])
+  True
+  >>> matches('"c"', ['"a"'])
+  False
+  """
+  if header.strip() == '*':
+    return True
+
+  # weak comparison as required for If-None-Match
+  tags = set(x.strip()[2:] if x.strip().startswith('W/') else x.strip()
+             for x in header.split(','))
+  return not tags.isdisjoint(etags)
+
+class PageCache:
+  """
+  :param create_body: returns the body of a page given its number
+  :type  create_body: callable(int)
+
+  :param pages: numbers of the pages to precompute.
+    Other pages are computed on every request, compressed only in the
+    content coding selected.
+  :type  pages: [int]
+
+  :param encodings: content codings to precompute
+  :type  encodings: [str]
+
+  >>> pc = PageCache(lambda pn: str(pn).encode() * 100, range(1, 3))
+  >>> body, etag, coding = pc.select(1, 'deflate, gzip')
+  >>> coding, zlib.decompress(body, 16 + zlib.MAX_WBITS) == b'1' * 100
+  ('gzip', True)
+  >>> pc.not_modified(etag, etag), pc.not_modified(pc.select(2, '')[1], etag)
+  (True, False)
+  >>> body, etag, coding = pc.select(5, 'gzip')
+  >>> coding, zlib.decompress(body, 16 + zlib.MAX_WBITS) == b'5' * 100
+  ('gzip', True)
+  >>> pc.not_modified(pc.select(5, '')[1], etag)
+  True
+  """
+
+  def __init__(pc, create_body, pages, encodings = encodings):
+    pc._create_body = create_body
+    pc._encodings = tuple(encodings)
+    pc._pages = dict((pn, pc._create(pn)) for pn in pages)
+
+  def select(pc, pn, accept_encoding):
+    """
+    :param pn: page number
+    :type  pn: int
+
+    :param accept_encoding: value of the Accept-Encoding header
+    :type  accept_encoding: str
+
+    :returns: body, its ETag and content coding preferably compressed in
+      one of the `accept_encoding`
+    :rtype: (bytes, str, str)
+    """
+    accepted = accepted_encodings(accept_encoding)
+    codings = [x for x in pc._encodings if x in accepted]
+
+    page = pc._pages.get(pn)
+    if page is None:
+      page = create_page(pc._create_body(pn), codings[:1])
+
+    for x in codings:
+      if x in page.variants:
+        return page.variants[x] + (x,)
+
+    return page.variants['identity'] + ('identity',)
+
+  def not_modified(pc, etag, if_none_match):
+    """
+    :param etag: ETag of the current page as returned by `select`
+    :type  etag: str
+
+    :param if_none_match: value of the If-None-Match header
+    :type  if_none_match: str
+
+    :returns: True if the client has a current representation of the
+      page in any content coding
+    :rtype: bool
+    """
+    etag = _body_etag(etag)
+    return matches(
+      if_none_match
+    , [_variant_etag(etag, x) for x in ('identity',) + pc._encodings]
+    )
+
+  def _create(pc, pn):
+    return create_page(pc._create_body(pn), pc._encodings)
@@ -4,6 +4,9 @@
 Minimal possible anonymous session management using in memory session
 storage and UUID4 as session ID.
 
+With a `Signer` the session ID is signed, which also allows running
+without any session storage (see `NullStore`).
+
 .. todo::
 
   Re-generate session id to make session hijacking harder.
@@ -12,36 +15,51 @@ storage and UUID4 as session ID.
 
   Encrypt ID to obfuscate it's structure.
 
-.. todo::
-
-  Sign session ID to prevent spoofing.
-
 .. seealso::
 
   https://www.owasp.org/index.php/Session_Management_Cheat_Sheet
 """
 
+import abc
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import sqlite3
+import time
 import uuid
 
-def create_middleware_factory(cc, uuid_factory = uuid.uuid4):
+def create_middleware_factory(
+  cc
+, uuid_factory  = uuid.uuid4
+, store_factory = None
+):
   """
   :param cc:
   :type  cc: CookieConfig
+
+  :param store_factory: creates the session store.
+    Unbounded `MemoryStore` by default.
+  :type  store_factory: callable
   """
+  store_factory = store_factory or MemoryStore
+
   async def factory(app, handler):
-    cs = _CookieStore(cc, app, uuid_factory)
+    cs = _CookieStore(cc, app, uuid_factory, store_factory)
     async def middleware(r):
       """
       :param r:
       :type  r: aiohttp.web.Request
       """
-      r['session'] = cs.get_session(r)
+      r['session'] = await cs.get_session(r)
 
       response = await handler(r)
       if response.started:
         raise RuntimeError("Response started. Can not save session.")
 
-      cs.set_cookie(response)
+      cs.set_cookie(response, r['session'])
       return response
 
     return middleware
@@ -57,11 +75,17 @@ class CookieConfig():
   , path     = '/'
   , secure   = None
   , httponly = True
+  , signer   = None
   ):
     """
     The parameters correspond to aiohttp.web.Response.set_cookie
+    except for
+
+    :param signer: signs the session id stored in the cookie if given
+    :type  signer: Signer
     """
     cc._name   = name
+    cc._signer = signer
     cc._params = dict(
       domain   = domain
     , max_age  = max_age
@@ -78,15 +102,22 @@ class CookieConfig():
   def params(cc):
     return cc._params
 
+  @property
+  def signer(cc):
+    return cc._signer
+
 class _CookieStore:
   """
+  Shared by all requests handled by the middleware, so any state of a
+  single request must be kept on the request.
+
   .. todo::
 
     this might work nicer as context manager inside the middleware
   """
   _store_key = 'session_store'
 
-  def __init__(cs, cc, app, uuid_factory):
+  def __init__(cs, cc, app, uuid_factory, store_factory):
     """
     :param cc:
     :type  cc: CookieConfig
@@ -94,8 +125,9 @@ class _CookieStore:
     cs._config = cc
     cs._app = app
     cs._create_uuid = uuid_factory
+    cs._create_store = store_factory
 
-  def get_session(cs, request):
+  async def get_session(cs, request):
     """
     :param request:
     :type  request: aiohttp.web.Request
@@ -103,27 +135,32 @@ class _CookieStore:
     :rtype: Session
     """
     cookie = cs._get_cookie(request)
+    store = cs._get_store()
 
-    if cookie not in cs._get_store():
+    session = None if cookie is None else await _call(store, store.get, cookie)
+    if session is None:
       # cookie is either new or was forgotten by the session store
-      # (due to server restart)
-      cookie = cs._create_uuid()
+      # (due to server restart or expiry)
+      session = await _call(store, store.create, cs._create_uuid())
 
-    # remember the cookie, so it can be written to the response
-    cs._cookie = cookie
+    return session
 
-    cs._get_store()[cookie] = Session(cookie)
-    return cs._get_store()[cookie]
-
-  def set_cookie(cs, response):
+  def set_cookie(cs, response, session):
     """
     :param response:
     :type  response: aiohttp.web.Response
+
+    :param session: session of the request the response belongs to
+    :type  session: Session
     """
 
+    cookie = session.id
+    if cs._config.signer is not None:
+      cookie = cs._config.signer.dumps(cookie)
+
     response.set_cookie(
       cs._config.name
-    , cs._cookie
+    , cookie
     , **cs._config.params
     )
 
@@ -131,10 +168,10 @@ class _CookieStore:
   def _get_store(cs):
     """
     :returns: session store
-    :rtype: dict
+    :rtype: SessionStore
     """
     if not cs._store_key in cs._app:
-      cs._app[cs._store_key] = dict()
+      cs._app[cs._store_key] = cs._create_store()
 
     return cs._app[cs._store_key]
 
@@ -147,6 +184,9 @@ class _CookieStore:
     if cookie is None:
       return None
 
+    if cs._config.signer is not None:
+      return cs._config.signer.loads(cookie)
+
     try:
       return uuid.UUID("{{{}}}".format(cookie))
     except ValueError:
@@ -159,3 +199,371 @@ class Session():
     :type  id: uuid.UUID
     """
     s.id = id_
+
+class Signer:
+  """
+  Signs session ids along with the time of signing using HMAC-SHA256,
+  so they can be verified by any process knowing the `secret`.
+
+  :param secret:
+  :type  secret: bytes
+
+  :param max_age: seconds after which the signature expires.
+    None for never.
+  :type  max_age: float
+
+  :param clock: returns current unix time
+  :type  clock: callable
+  """
+
+  def __init__(sg, secret, *, max_age = None, clock = time.time):
+    sg._secret = secret
+    sg._max_age = max_age
+    sg._clock = clock
+
+  def dumps(sg, id_):
+    """
+    :param id_:
+    :type  id_: uuid.UUID
+
+    :returns: signed session id
+    :rtype: str
+    """
+    payload = "{}.{:x}".format(id_.hex, int(sg._clock()))
+    return payload + "." + sg._sign(payload)
+
+  def loads(sg, value):
+    """
+    :param value: as returned by `dumps`
+    :type  value: str
+
+    :returns: session id or None if the value is invalid or expired
+    :rtype: uuid.UUID
+    """
+    try:
+      id_, issued, signature = value.split(".")
+    except ValueError:
+      return None
+
+    payload = id_ + "." + issued
+    if not hmac.compare_digest(
+      signature.encode("utf-8")
+    , sg._sign(payload).encode("utf-8")
+    ):
+      return None
+
+    issued = int(issued, 16)
+    if sg._max_age is not None and issued + sg._max_age < sg._clock():
+      return None
+
+    return uuid.UUID(id_)
+
+  def _sign(sg, payload):
+    digest = hmac.new(sg._secret, payload.encode("utf-8"), hashlib.sha256)
+    return base64.urlsafe_b64encode(digest.digest()).rstrip(b"=") \
+      .decode("ascii")
+
+class SessionStore(abc.ABC):
+  """
+  Interface of the session stores.
+  """
+
+  executor = None
+  """
+  executor to call `get` and `create` in if they block,
+  None to call them on the event loop
+  """
+
+  @abc.abstractmethod
+  def get(st, id_):
+    """
+    Marks the session as used.
+
+    :param id_:
+    :type  id_: uuid.UUID
+
+    :returns: the session or None if it is not known (anymore)
+    :rtype: Session
+    """
+
+  @abc.abstractmethod
+  def create(st, id_):
+    """
+    Starts remembering a new session.
+
+    :param id_:
+    :type  id_: uuid.UUID
+
+    :rtype: Session
+    """
+
+  def close(st):
+    """
+    Releases resources held by the store.
+    """
+
+async def _call(store, f, *args):
+  """
+  :returns: `f(*args)` called in the `store.executor` if it has one
+  """
+  if store.executor is None:
+    return f(*args)
+
+  return await asyncio.get_event_loop().run_in_executor(
+    store.executor, f, *args
+  )
+
+async def close_store(app):
+  """
+  Cleanup handler closing the session store of the `app` if it has one.
+  """
+  store = app.get(_CookieStore._store_key)
+  if store is not None:
+    store.close()
+
+def store_stats(app):
+  """
+  :returns: counters of the session store of the `app`, those it does
+    not keep left out, or None if it has no store yet
+  :rtype: dict
+  """
+  store = app.get(_CookieStore._store_key)
+  if store is None:
+    return None
+
+  return {
+    k: getattr(store, k)
+    for k in ('expired', 'evicted')
+    if getattr(store, k, None) is not None
+  }
+
+class NullStore(SessionStore):
+  """
+  Session store which does not store anything and knows every session.
+  Meant for signed session ids (see `CookieConfig.signer`) whose
+  signature is all there is to verify.
+  """
+
+  def get(ns, id_):
+    return Session(id_)
+
+  def create(ns, id_):
+    return Session(id_)
+
+class MemoryStore(SessionStore):
+  """
+  In memory session store which forgets sessions idle for longer than
+  `ttl` seconds and the least recently used sessions once there are more
+  than `max_entries` of them.
+
+  The sessions are kept ordered by the time of their last use, so the
+  expired ones are always the oldest and are swept lazily from the front
+  in amortized O(1).
+
+  :param ttl: None to never expire sessions
+  :type  ttl: float
+
+  :param max_entries: None to keep any number of sessions
+  :type  max_entries: int
+
+  :param clock: returns current time in seconds
+  :type  clock: callable
+  """
+
+  def __init__(ms, *, ttl = None, max_entries = None, clock = time.monotonic):
+    ms._ttl = ttl
+    ms._max_entries = max_entries
+    ms._clock = clock
+
+    # session id: (time of last use, Session)
+    ms._sessions = collections.OrderedDict()
+
+    ms.expired = 0
+    """number of sessions forgotten due to `ttl`"""
+
+    ms.evicted = 0
+    """number of sessions forgotten due to `max_entries`"""
+
+  def get(ms, id_):
+    ms._expire()
+    if id_ not in ms._sessions:
+      return None
+
+    return ms._touch(id_, ms._sessions[id_][1])
+
+  def create(ms, id_):
+    ms._expire()
+    session = ms._touch(id_, Session(id_))
+
+    if ms._max_entries is not None:
+      while len(ms._sessions) > ms._max_entries:
+        ms._sessions.popitem(last = False)
+        ms.evicted += 1
+
+    return session
+
+  def __contains__(ms, id_):
+    ms._expire()
+    return id_ in ms._sessions
+
+  def __len__(ms):
+    return len(ms._sessions)
+
+  def _touch(ms, id_, session):
+    ms._sessions[id_] = (ms._clock(), session)
+    ms._sessions.move_to_end(id_)
+    return session
+
+  def _expire(ms):
+    if ms._ttl is None:
+      return
+
+    deadline = ms._clock() - ms._ttl
+    while ms._sessions:
+      last_used, _ = next(iter(ms._sessions.values()))
+      if last_used > deadline:
+        break
+
+      ms._sessions.popitem(last = False)
+      ms.expired += 1
+
+class SqliteStore(SessionStore):
+  """
+  Session store in a SQLite database in WAL mode, which can be shared by
+  processes on the same host.
+
+  New sessions are written right away, so the other processes know
+  them. Updates of the last use are written in batches, every
+  `flush_interval` seconds or `flush_size` sessions. Sessions idle for
+  longer than `ttl` seconds are deleted along with the flushes, at most
+  every `expire_interval` seconds.
+
+  The database may be locked by other processes for up to the busy
+  timeout, so the middleware calls the store in its single thread
+  `executor`.
+
+  :param path: database file
+  :type  path: str
+
+  :param ttl: None to never expire sessions
+  :type  ttl: float
+
+  :param flush_interval:
+  :type  flush_interval: float
+
+  :param flush_size:
+  :type  flush_size: int
+
+  :param expire_interval:
+  :type  expire_interval: float
+
+  :param clock: returns current unix time
+  :type  clock: callable
+  """
+
+  def __init__(
+    sq
+  , path
+  , *
+  , ttl             = None
+  , flush_interval  = 1.0
+  , flush_size      = 1000
+  , expire_interval = 60.0
+  , clock           = time.time
+  ):
+    sq._ttl = ttl
+    sq._flush_interval = flush_interval
+    sq._flush_size = flush_size
+    sq._expire_interval = expire_interval
+    sq._clock = clock
+
+    sq.executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    # used by the executor thread, or any thread once it is shut down
+    sq._db = sqlite3.connect(
+      path, isolation_level = None, check_same_thread = False
+    )
+    sq._db.execute("PRAGMA journal_mode = WAL")
+    sq._db.execute("PRAGMA synchronous = NORMAL")
+    sq._db.execute("PRAGMA busy_timeout = 5000")
+    sq._db.execute("""
+      CREATE TABLE IF NOT EXISTS sessions (
+        id        BLOB PRIMARY KEY
+      , last_seen REAL NOT NULL
+      ) WITHOUT ROWID
+    """)
+    sq._db.execute("""
+      CREATE INDEX IF NOT EXISTS sessions_last_seen_idx
+      ON sessions (last_seen)
+    """)
+
+    # session id bytes: time of last use not written yet
+    sq._pending = dict()
+    sq._flushed = sq._expired = clock()
+
+    sq.expired = 0
+    """number of sessions deleted due to `ttl`"""
+
+  def get(sq, id_):
+    now = sq._clock()
+    key = id_.bytes
+
+    if not sq._fresh(sq._pending.get(key), now):
+      # other processes may have used the session meanwhile
+      row = sq._db.execute(
+        "SELECT last_seen FROM sessions WHERE id = ?", (key,)
+      ).fetchone()
+
+      if row is None or not sq._fresh(row[0], now):
+        return None
+
+    sq._pending[key] = now
+    sq._maybe_flush(now)
+    return Session(id_)
+
+  def create(sq, id_):
+    now = sq._clock()
+    sq._db.execute(
+      "INSERT OR REPLACE INTO sessions (id, last_seen) VALUES (?, ?)"
+    , (id_.bytes, now)
+    )
+    sq._maybe_flush(now)
+    return Session(id_)
+
+  def flush(sq):
+    """
+    Writes the pending updates and deletes the expired sessions if due.
+    """
+    now = sq._clock()
+
+    with sq._db:
+      sq._db.execute("BEGIN IMMEDIATE")
+      sq._db.executemany(
+        "UPDATE sessions SET last_seen = max(last_seen, ?) WHERE id = ?"
+      , [(t, key) for key, t in sq._pending.items()]
+      )
+
+      if sq._ttl is not None and now - sq._expired >= sq._expire_interval:
+        sq.expired += sq._db.execute(
+          "DELETE FROM sessions WHERE last_seen < ?", (now - sq._ttl,)
+        ).rowcount
+        sq._expired = now
+
+    sq._pending.clear()
+    sq._flushed = now
+
+  def close(sq):
+    sq.executor.shutdown()
+    sq.flush()
+    sq._db.close()
+
+  def _fresh(sq, last_seen, now):
+    if last_seen is None:
+      return False
+
+    return sq._ttl is None or last_seen >= now - sq._ttl
+
+  def _maybe_flush(sq, now):
+    if len(sq._pending) >= sq._flush_size \
+    or now - sq._flushed >= sq._flush_interval:
+      sq.flush()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append-only on-disk spool for hits which could not be inserted into the
+database in time.
+
+The spool is a directory of segment files. Hits are appended as JSON
+lines to the single open segment which gets closed once it grows over
+`segment_size`. Only closed segments are replayed.
+
+All methods do blocking I/O, so run them in an executor when called
+from the event loop.
+"""
+
+import json
+import os
+import time
+import uuid
+
+class Spool:
+  """
+  :param path: spool directory. Created if missing.
+  :type  path: str
+
+  :param segment_size: size in bytes after which the open segment is
+    closed and a new one started.
+  :type  segment_size: int
+
+  :param fsync: when to fsync the open segment. One of `fsync_policies`.
+  :type  fsync: str
+  """
+
+  fsync_policies = ('always', 'rotate', 'never')
+
+  _open_suffix = '.open'
+  _closed_suffix = '.seg'
+
+  def __init__(s, path, *, segment_size = 16 * 1024 * 1024, fsync = 'rotate'):
+    if fsync not in s.fsync_policies:
+      raise ValueError('Invalid fsync policy ' + repr(fsync))
+
+    s._path = path
+    s._segment_size = segment_size
+    s._fsync = fsync
+    s._file = None
+
+    os.makedirs(path, exist_ok = True)
+
+    # segments left open by a crash are as good as closed ones
+    for x in os.listdir(path):
+      if x.endswith(s._open_suffix):
+        s._close_segment(os.path.join(path, x))
+
+  def append(s, row):
+    """
+    :param row: `model.hits` row
+    :type  row: dict
+    """
+    s.extend([row])
+
+  def extend(s, rows):
+    """
+    Appends `rows` with a single flush, and fsync if `always`.
+
+    :param rows: `model.hits` rows
+    :type  rows: [dict]
+    """
+    if s._file is None:
+      s._file = open(s._segment_path(s._open_suffix), 'a', encoding = 'utf-8')
+
+    s._file.write(''.join(json.dumps(x, default = str) + '\n' for x in rows))
+    s._file.flush()
+
+    if s._fsync == 'always':
+      os.fsync(s._file.fileno())
+
+    if s._file.tell() >= s._segment_size:
+      s.rotate()
+
+  def rotate(s):
+    """
+    Closes the open segment, making it available to `segments`.
+    """
+    if s._file is None:
+      return
+
+    if s._fsync != 'never':
+      os.fsync(s._file.fileno())
+
+    s._file.close()
+    s._close_segment(s._file.name)
+    s._file = None
+
+  def segments(s):
+    """
+    :returns: paths of closed segments, oldest first
+    :rtype: [str]
+    """
+    return sorted(
+      os.path.join(s._path, x)
+      for x in os.listdir(s._path)
+      if x.endswith(s._closed_suffix)
+    )
+
+  def read(s, segment):
+    """
+    :returns: rows stored in the segment.
+      A partially written last line is skipped.
+    :rtype: [dict]
+    """
+    rows = []
+    with open(segment, encoding = 'utf-8') as f:
+      for line in f:
+        try:
+          row = json.loads(line)
+        except ValueError:
+          continue
+
+        row['session_id'] = uuid.UUID(row['session_id'])
+        rows.append(row)
+
+    return rows
+
+  def remove(s, segment):
+    os.unlink(segment)
+
+  def close(s):
+    s.rotate()
+
+  def _segment_path(s, suffix):
+    # names sort in creation order as long as the clock does not go back
+    return os.path.join(
+      s._path
+    , '{:020d}-{}{}'.format(int(time.time() * 1e6), os.getpid(), suffix)
+    )
+
+  def _close_segment(s, path):
+    os.rename(path, path[:-len(s._open_suffix)] + s._closed_suffix)
+
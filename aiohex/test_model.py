@@ -18,9 +18,12 @@ class Model:
   async def get_sessions(m, _):
     return iter(m.hits)
 
-  def connect(m, _):
+  def connect(m, _, **kwargs):
     return None
 
+  def create_tables(m, _, **kwargs):
+    pass
+
 class Fixture(Model):
   def __init__(m):
     uuid_gen = mk_uuid()
@@ -53,11 +56,39 @@ class Fixture(Model):
     # 1, 2 = 1      2, 2 = 0      3, 2 = 1
     # 1, 3 = 1      2, 3 = 2      3, 3 = 2
 
-  async def get_transitions(m, _, exit_state = None):
+    # the `edges` are no walks, so pages visited by the sessions in
+    # order are given separately
+    sids = list(m.edges)
+    m.visits = {
+      sids[0]: [1, 2, 3, 3, 1]
+    , sids[1]: [2, 3, 3, 2, 1]
+    }
+
+  async def get_transitions(m, _, exit_state = None, chunk_size = None):
     return dict([
       (sid, markov.Graph.from_edges(m.edges[sid]))
       for sid in m.edges
     ])
 
+  async def get_session_transitions(m, e, session_id, exit_state = None):
+    return (await m.get_transitions(e, exit_state)).get(session_id)
+
+  async def get_aggregated_transitions(m, e, exit_state = None):
+    counts = markov.Counts()
+    for tg in (await m.get_transitions(e, exit_state)).values():
+      counts += markov.Counts.from_graph(tg)
+
+    return counts
+
+  async def fold_transitions(m, e, exit_state = None, chunk_size = None):
+    return await m.get_aggregated_transitions(e, exit_state)
+
+  async def count_paths(m, _, order, max_paths = None, chunk_size = None):
+    paths = markov.Paths(order, max_paths)
+    for sid, pages in m.visits.items():
+      paths.add_sessions(pages, [sid] * len(pages))
+
+    return paths
+
   async def get_sessions(m, _):
     return m.edges.keys()
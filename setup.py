@@ -23,6 +23,7 @@ setup(
   , "sqlalchemy"
   , "networkx"
   , "numpy"
+  , "scipy"
   , "pyxdg"
   ]
 
@@ -55,3 +55,32 @@ Test the markov graph probability computation and drawing
         ---  20 % --->     | 2 |
                            +---+
   
+  $ aiohex transitions --top-k 1
+  Aggregated transitions:
+  
+  +---+                    +------+
+  | 1 | ---  50 % --->     | exit |
+  +---+                    +------+
+  
+  +---+                    +---+
+  | 2 | ---  67 % --->     | 3 |
+  +---+                    +---+
+  
+  +---+                    +---+
+  | 3 | ---  40 % --->     | 1 |
+  +---+                    +---+
+  
+  $ aiohex transitions --session-length
+  Aggregated transitions:
+  
+  Expected session length: 6.00
+  
+  2     7.36
+  3     7.21
+  1     4.64
+  $ aiohex paths --order 3 --top 5
+  2 1 -> exit
+  2 2 -> 3
+  2 2 -> 3 -> 3
+  2 3 -> 3
+  1 1 -> 2
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import uuid
+
+import pytest
+import sqlalchemy as sa
+
+from aiohex import model
+
+# postgresql database to run the tests in. Its tables get dropped.
+dsn = os.environ.get('AIOHEX_TEST_DSN')
+
+requires_db = pytest.mark.skipif(
+  not dsn
+, reason = "AIOHEX_TEST_DSN is not set"
+)
+
+def drop_tables():
+  e = sa.create_engine(dsn)
+  model.metadata.drop_all(e)
+  e.dispose()
+
+async def count_by_partition(engine):
+  async with engine.acquire() as conn:
+    xs = await conn.execute(
+      "SELECT tableoid::regclass::text, count(*) FROM hits GROUP BY 1"
+    )
+    return dict(await xs.fetchall())
+
+async def fetch_all(engine, q):
+  async with engine.acquire() as conn:
+    return sorted(tuple(x) for x in await (await conn.execute(q)).fetchall())
+
+@requires_db
+def test_create_partitions_after_hits():
+  drop_tables()
+
+  run = asyncio.get_event_loop().run_until_complete
+  e = model.connect(model.DSN(dsn), partition_by = 'id')
+  sid = uuid.UUID("{00000000-0000-0000-0000-000000000001}")
+
+  def hits(n):
+    return [model._hit_row(1, sid, '127.0.0.1', 1, None) for _ in range(n)]
+
+  run(model.register_hits(e, hits(15)))
+  assert run(count_by_partition(e)) == {'hits_default': 15}
+
+  names = run(model.create_partitions(e, 'id', 10, ahead = 1))
+  assert names == ['hits_p10_20', 'hits_p20_30']
+  assert run(count_by_partition(e)) == {'hits_default': 9, 'hits_p10_20': 6}, \
+    "hits of the new range are moved out of the default partition"
+
+  run(model.create_partitions(e, 'id', 10, ahead = 1))
+  run(model.register_hits(e, hits(10)))
+  assert run(count_by_partition(e)) == {
+    'hits_default' : 9
+  , 'hits_p10_20'  : 10
+  , 'hits_p20_30'  : 6
+  }
+
+  e.close()
+  run(e.wait_closed())
+
+@requires_db
+def test_create_partitions_keeps_tracked_transitions():
+  drop_tables()
+
+  run = asyncio.get_event_loop().run_until_complete
+  e = model.connect(
+    model.DSN(dsn), partition_by = 'id', track_transitions = True
+  )
+  sids = [
+    uuid.UUID("{{00000000-0000-0000-0000-{:012x}}}".format(x))
+    for x in (1, 2)
+  ]
+
+  run(model.register_hits(e, [
+    model._hit_row(page, sids[i % 2], '127.0.0.1', 1, None)
+    for i, page in enumerate([1, 1, 2, 3, 3, 2, 1, 2, 2, 1, 3, 3, 1, 2, 3])
+  ]))
+
+  def state():
+    return (
+      run(fetch_all(e, "SELECT from_page, to_page, n FROM transition_counts"))
+    , run(fetch_all(e, "SELECT session_id, page_no FROM session_heads"))
+    )
+
+  before = state()
+  run(model.create_partitions(e, 'id', 10, ahead = 1))
+  assert run(count_by_partition(e))['hits_p10_20'] == 6
+  assert state() == before, "moved hits are not counted again"
+
+  e.close()
+  run(e.wait_closed())
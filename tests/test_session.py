@@ -2,6 +2,8 @@
 
 import asyncio
 import functools
+import json
+import random
 from http import cookies
 import uuid
 
@@ -12,6 +14,9 @@ from aiohttp import parsers
 from aiohttp.web_reqrep import Request
 
 from aiohex.session import CookieConfig, create_middleware_factory
+from aiohex.session import MemoryStore, NullStore, Session, Signer, SqliteStore
+from aiohex.session import store_stats
+from aiohex import core
 
 async def empty_handler(r):
   return web.Response()
@@ -116,3 +121,162 @@ def test_sessions_middleware():
   exp_cookie[cc.name] = uuids[session]
   assert str(response.cookies) == str(exp_cookie) \
   , "client with invalid cookie gets a new one"
+
+def test_sessions_middleware_concurrency():
+  loop = asyncio.get_event_loop()
+  rng = random.Random(0)
+
+  cc = CookieConfig()
+  store = MemoryStore()
+  known = [uuid.uuid4() for _ in range(1000)]
+  for x in known:
+    store.create(x)
+
+  async def handler(r):
+    # let the other requests interleave with this one
+    for _ in range(rng.randrange(4)):
+      await asyncio.sleep(0)
+    return web.Response()
+
+  f = create_middleware_factory(cc, store_factory = lambda: store)
+  app = web.Application()
+  middleware = loop.run_until_complete(f(app, handler))
+
+  requests = [
+    create_request([
+      'GET /1 HTTP/1.1'
+    , 'Cookie: {}={}'.format(cc.name, x)
+    ])
+    for x in known
+  ] + [
+    create_request(['GET /1 HTTP/1.1'])
+    for _ in range(1000)
+  ]
+  rng.shuffle(requests)
+
+  responses = loop.run_until_complete(
+    asyncio.gather(*[middleware(r) for r in requests])
+  )
+
+  new = set()
+  for request, response in zip(requests, responses):
+    cookie = response.cookies[cc.name].value
+    assert cookie == str(request['session'].id) \
+    , "response carries the session of its request"
+
+    sent = request.cookies.get(cc.name)
+    if sent is None:
+      new.add(cookie)
+    else:
+      assert cookie == sent, "known client keeps its session"
+
+  assert len(new) == 1000, "each new client gets its own session"
+
+def test_memory_store_expiry():
+  now = [0]
+  ms = MemoryStore(ttl = 10, max_entries = 2, clock = lambda: now[0])
+
+  ms.create(1)
+  now[0] = 5
+  ms.create(2)
+  assert 1 in ms and 2 in ms
+
+  now[0] = 11
+  assert ms.get(1) is None, "idle session expires"
+  assert ms.get(2).id == 2
+  assert ms.expired == 1
+
+  ms.create(3)
+  ms.create(4)
+  assert 2 not in ms, "least recently used session is evicted"
+  assert 3 in ms and 4 in ms
+  assert ms.evicted == 1
+
+  now[0] = 15
+  ms.get(3)
+  now[0] = 21
+  assert ms.get(3).id == 3, "use refreshes the session"
+  assert ms.get(4) is None
+  assert len(ms) == 1
+
+def test_stats_view():
+  loop = asyncio.get_event_loop()
+
+  class Pool:
+    def stats(p):
+      return dict(size = 1)
+
+  class StatsRequest:
+    app = web.Application()
+
+  r = StatsRequest()
+  r.app['db'] = Pool()
+  assert store_stats(r.app) is None, "no store before the first request"
+
+  ms = MemoryStore(ttl = 10, max_entries = 1, clock = lambda: 0)
+  ms.expired = 3
+  ms.create(1)
+  ms.create(2)
+  r.app['session_store'] = ms
+
+  response = loop.run_until_complete(core.stats_view(r))
+  assert json.loads(response.text) == {
+    'pool'     : {'size': 1}
+  , 'sessions' : {'expired': 3, 'evicted': 1}
+  }
+
+  r.app['session_store'] = NullStore()
+  assert store_stats(r.app) == {}, "stores without counters still work"
+
+def test_sqlite_store(tmpdir):
+  now = [1000]
+  path = str(tmpdir.join("sessions.db"))
+  id_ = uuid.UUID("{00000000-0000-0000-0000-000000000001}")
+
+  def create_store():
+    return SqliteStore(
+      path
+    , ttl             = 10
+    , flush_interval  = 100
+    , expire_interval = 0
+    , clock           = lambda: now[0]
+    )
+
+  a = create_store()
+  b = create_store()
+
+  a.create(id_)
+  assert b.get(id_).id == id_, "new sessions are shared right away"
+  assert b.get(uuid.uuid4()) is None
+
+  now[0] = 1006
+  a.get(id_)
+  now[0] = 1012
+  assert b.get(id_) is None, "last use is not written until flushed"
+
+  a.flush()
+  assert b.get(id_).id == id_
+
+  now[0] = 1030
+  b.flush()
+  assert b.expired == 1
+  assert a.get(id_) is None
+
+  a.close()
+  b.close()
+
+def test_signer():
+  now = [1000]
+  sg = Signer(b"secret", max_age = 10, clock = lambda: now[0])
+  id_ = uuid.UUID("{00000000-0000-0000-0000-000000000001}")
+
+  value = sg.dumps(id_)
+  assert sg.loads(value) == id_
+
+  assert Signer(b"other").loads(value) is None, "wrong secret"
+  assert sg.loads(value.replace("1.", "2.", 1)) is None, "tampered id"
+  assert sg.loads(str(id_)) is None, "unsigned id"
+  assert sg.loads("a.b.c.d") is None
+
+  now[0] = 1011
+  assert sg.loads(value) is None, "expired signature"